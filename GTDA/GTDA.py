@@ -1,6 +1,8 @@
 from logging import warning
-from .GTDA_utils import find_components
-from bisect import bisect_right
+from .GTDA_utils import find_components_array, group_subgraphs, group_subgraph, block_diagonal, \
+    ComponentStore, NodeAssignments, StageProfiler, NeighborIndex, overlap_adjacency, \
+    UnionFind, GraphOperator, diffuse, get_index_dtype, topk_lens, lens_min_max, lens_std, lens_column, lens_nbytes, \
+    row_max, row_argmax, segment_min_max, segment_std, lens_values
 import numpy as np
 import scipy.sparse as sp
 from collections import defaultdict, Counter
@@ -22,342 +24,470 @@ def is_overlap(x,y):
             return False
     return True
 
+# Splits one component of a level along its lens values vals, unless its largest difference is below split_thd
+def split_component(vals,G_sub,component_id,largest_diff,col_to_filter,nbins_pyramid,overlap,
+    component_size_thd,split_thd):
+    if largest_diff < split_thd:
+        return None,component_id,largest_diff,col_to_filter
+    bins,_ = GTDA.filtering(vals[:,None],[0],nbins=nbins_pyramid,overlap=overlap)
+    graph_clusters = GTDA.graph_clustering(G_sub,bins,component_size_thd=component_size_thd)
+    return graph_clusters,component_id,largest_diff,col_to_filter
+
+# Splits the components at positions of a level laid out as in find_reeb_nodes, position k being
+# level_indptr[k]:level_indptr[k+1]. It lives at module level and takes the arrays of the whole level, so
+# that a process backend gets one task per worker holding these arrays, which joblib memmaps into shared
+# memory once per level when they are large, rather than one pickled copy per component or the GTDA object.
+def split_components(level_vals,level_subgraphs,level_indptr,positions,component_ids,largest_diffs,cols,
+    nbins_pyramid,overlap,component_size_thd,split_thd):
+    return [split_component(
+        level_vals[level_indptr[k]:level_indptr[k+1]],group_subgraph(level_subgraphs,level_indptr,k),
+        component_id,largest_diff,col,nbins_pyramid,overlap,component_size_thd,split_thd)
+        for k,component_id,largest_diff,col in zip(positions,component_ids,largest_diffs,cols)]
+
 class GTDA(object):
-    def __init__(self,nn_model,labels_to_eval):
+    # levels with fewer samples to split than this are split in the calling process whatever nprocs is,
+    # starting workers would take longer than splitting them
+    parallel_min_samples = 1<<16
+
+    def __init__(self,nn_model,labels_to_eval,dtype=np.float64,index_dtype=None,lens_topk=None):
+        self.dtype = np.dtype(dtype)
+        self.index_dtype = index_dtype
         self.A = nn_model.A
-        self.preds = np.copy(nn_model.preds)
+        # the top-k lens is taken from nn_model.preds directly, a dense lens is never copied
+        self.lens_topk = lens_topk
+        if lens_topk is not None:
+            self.preds = topk_lens(nn_model.preds,lens_topk,dtype=self.dtype)
+        elif sp.issparse(nn_model.preds):
+            self.preds = sp.csr_matrix(nn_model.preds,dtype=self.dtype,copy=True)
+        else:
+            self.preds = np.array(nn_model.preds,dtype=self.dtype)
         self.labels_to_eval = copy.copy(labels_to_eval)
+        self.profiler = StageProfiler()
     
-    def _compute_bin_lbs(self,inner_id,overlap,col_id,nbins):
+    # normalized reeb adjacency of the mixing rate diffusion, built on first use since cg does not need it
+    @property
+    def An(self):
+        return self.reeb_operator.normalized(self.mixing_degree_normalize)
+
+    @staticmethod
+    def _compute_bin_lbs(inner_id,overlap,col_id,nbins,pre_lbs,bin_sizes):
         if inner_id >= nbins or inner_id < 0:
             return float("inf")
-        curr_lb = self.pre_lbs[col_id]+self.bin_sizes[col_id]*inner_id
+        curr_lb = pre_lbs[col_id]+bin_sizes[col_id]*inner_id
         if inner_id != 0:
-            curr_lb -= overlap*self.bin_sizes[col_id]
+            curr_lb -= overlap*bin_sizes[col_id]
         return curr_lb
     
-    def _compute_bin_ubs(self,inner_id,overlap,col_id,nbins):
+    @staticmethod
+    def _compute_bin_ubs(inner_id,overlap,col_id,nbins,pre_lbs,bin_sizes):
         if inner_id >= nbins or inner_id < 0:
             return -1*float("inf")
-        curr_ub = self.pre_lbs[col_id]+self.bin_sizes[col_id]*(1+inner_id)
+        curr_ub = pre_lbs[col_id]+bin_sizes[col_id]*(1+inner_id)
         if inner_id != nbins-1:
-            curr_ub += overlap*self.bin_sizes[col_id]
+            curr_ub += overlap*bin_sizes[col_id]
         return curr_ub
 
+    # Returns the lens M and the binarized graph Ar. Ar is the matrix of the cached GraphOperator of self.A,
+    # shared with later calls on the same graph, so its arrays are read-only, copy it before modifying it.
     def build_mixing_matrix(
-        self,alpha=0.5,nsteps=3,normalize=True,extra_lens=None,standardize=False,degree_normalize=1,verbose=False):
-        Ar = (self.A>0).astype(np.float64)
-        degs = np.sum(Ar,0)
-        dinv = 1/degs
-        dinv[dinv==np.inf] = 0
-        Dinv = sp.spdiags(dinv,0,Ar.shape[0],Ar.shape[0])
-        if degree_normalize == 1:
-            An = Dinv@Ar
-        elif degree_normalize == 2:
-            An = Ar@Dinv
-        elif degree_normalize == 3:
-            An = np.sqrt(Dinv)@Ar@np.sqrt(Dinv)
-        else:
-            An = Ar
-        total_mixing_all = np.copy(self.preds)
-        init_mixing = np.copy(self.preds)
-        if extra_lens is not None:
-            total_mixing_all = np.hstack([total_mixing_all,extra_lens])
-            init_mixing = np.hstack([init_mixing,extra_lens])
-        for i in tqdm(range(nsteps),disable=1-verbose):
-            total_mixing_all = (1-alpha)*init_mixing + alpha*An@total_mixing_all
-        selected_col = self.labels_to_eval
-        if extra_lens is not None:
-            selected_col += list(range(self.preds.shape[1],total_mixing_all.shape[1]))
-        M = total_mixing_all[:,selected_col].copy()
-        if standardize:
-            for i in range(M.shape[1]):
-                M[:,i] = (M[:,i]-np.mean(M[:,i]))/np.std(M[:,i])
-        if normalize:
-            for i in range(M.shape[1]):
-                if np.max(M[:,i]) != np.min(M[:,i]):
-                    M[:,i] = (M[:,i]-np.min(M[:,i]))/(np.max(M[:,i])-np.min(M[:,i]))
+        self,alpha=0.5,nsteps=3,normalize=True,extra_lens=None,standardize=False,degree_normalize=1,
+        tol=None,method="power",topk=None,nthreads=1,verbose=False):
+        with self.profiler.stage("build_mixing_matrix") as stage:
+            if topk is not None and topk != self.lens_topk:
+                self.preds = topk_lens(self.preds,topk)
+                self.lens_topk = topk
+            self.graph_operator = GraphOperator.get(self.A,dtype=self.dtype,nthreads=nthreads)
+            Ar = self.graph_operator.A
+            init_mixing = self.preds.copy()
+            if extra_lens is not None and (sp.issparse(init_mixing) or sp.issparse(extra_lens)):
+                init_mixing = sp.hstack([init_mixing,extra_lens],format="csr").astype(self.dtype)
+            elif extra_lens is not None:
+                init_mixing = np.hstack([init_mixing,extra_lens]).astype(self.dtype,copy=False)
+            total_mixing_all,self.lens_diffusion_info = diffuse(
+                self.graph_operator,init_mixing,alpha=alpha,nsteps=nsteps,degree_normalize=degree_normalize,tol=tol,method=method,
+                topk=self.lens_topk,topk_cols=self.preds.shape[1],verbose=verbose)
+            stage["info"].update(self.lens_diffusion_info)
+            selected_col = self.labels_to_eval
+            if extra_lens is not None:
+                selected_col += list(range(self.preds.shape[1],total_mixing_all.shape[1]))
+            if sp.issparse(total_mixing_all):
+                M = self._scale_sparse_lens(total_mixing_all[:,selected_col].tocsr(),normalize,standardize)
+                return M,Ar
+            M = total_mixing_all[:,selected_col].copy()
+            if standardize:
+                for i in range(M.shape[1]):
+                    M[:,i] = (M[:,i]-np.mean(M[:,i]))/np.std(M[:,i])
+            if normalize:
+                for i in range(M.shape[1]):
+                    if np.max(M[:,i]) != np.min(M[:,i]):
+                        M[:,i] = (M[:,i]-np.min(M[:,i]))/(np.max(M[:,i])-np.min(M[:,i]))
         return M,Ar
     
-    def _clustering_single_col_pyramid(self,
-        M,filter_cols,nbins,lbs=None,ubs=None):
-        self.pre_lbs = np.zeros(len(filter_cols))
-        self.pre_ubs = np.zeros(len(filter_cols))
-        self.bin_sizes = np.zeros(len(filter_cols))
-        self.lbs = np.min(M,0) if lbs is None else lbs
-        self.ubs = np.max(M,0) if ubs is None else ubs
+    # Shifting a sparse lens would fill in its implicit zeros, so its columns are only divided by their std
+    # and then by their range. Columns of the dense lens are shifted as well. Splitting, binning and edge
+    # distances only depend on differences of lens values, but these round differently without the shift,
+    # so split columns that are tied in exact arithmetic, such as p and 1-p, can go either way.
+    def _scale_sparse_lens(self,M,normalize,standardize):
+        scale = np.ones(M.shape[1])
+        if standardize:
+            std = lens_std(M)
+            scale[std > 0] = 1/std[std > 0]
+        if normalize:
+            lbs,ubs = lens_min_max(M)
+            ranges = (ubs-lbs)*scale
+            scale[ranges > 0] /= ranges[ranges > 0]
+        return (M@sp.diags(scale.astype(self.dtype))).tocsr()
+
+    # bin boundaries are returned rather than stored on self so that components
+    # of the same level can be filtered concurrently
+    @staticmethod
+    def _clustering_single_col_pyramid(M,filter_cols,nbins,lbs=None,ubs=None):
+        pre_lbs = np.zeros(len(filter_cols))
+        pre_ubs = np.zeros(len(filter_cols))
+        bin_sizes = np.zeros(len(filter_cols))
+        if lbs is None or ubs is None:
+            col_lbs,col_ubs = lens_min_max(M)
+            lbs = col_lbs if lbs is None else lbs
+            ubs = col_ubs if ubs is None else ubs
         for i,col in enumerate(filter_cols):
-            self.pre_lbs[i] = self.lbs[col]
-            self.pre_ubs[i] = self.ubs[col]
-            self.bin_sizes[i] = (self.ubs[col]-self.lbs[col])/nbins
+            pre_lbs[i] = lbs[col]
+            pre_ubs[i] = ubs[col]
+            bin_sizes[i] = (ubs[col]-lbs[col])/nbins
+        return pre_lbs,pre_ubs,bin_sizes
     
-    def _find_bins_pyramid(self,M,filter_cols,overlap,nbins):
-        bin_nums = 0
-        bin_key_map = {}
-        bin_map = {}
-        bins = defaultdict(list)
-        all_assignments = [[[] for _ in range(len(filter_cols))] for _ in range(M.shape[0])]
+    # Bins are numbered in order of first appearance, scanning samples in order and the
+    # keys of a sample like itertools.product over [primary, next, previous] bins of each
+    # column. Returns bins as (indptr, members), members of bin k being
+    # members[indptr[k]:indptr[k+1]] in increasing order, and the packed key of each bin.
+    @staticmethod
+    def _find_bins_pyramid(M,filter_cols,overlap,nbins,bounds):
+        pre_lbs,pre_ubs,bin_sizes = bounds
+        # candidate (sample, packed key, rank) triples, rank orders the keys of a sample
+        cand_samples = np.arange(M.shape[0],dtype=np.int64)
+        cand_keys = np.zeros(M.shape[0],dtype=np.int64)
+        cand_ranks = np.zeros(M.shape[0],dtype=np.int64)
         for j,col in enumerate(filter_cols):
-            bin_size = self.bin_sizes[j]
-            inner_id = np.floor((M[:,col]-self.pre_lbs[j])/bin_size).astype(np.int64)
-            boundary = np.nonzero(M[:,col] == self.pre_ubs[j])[0]
+            bin_size = bin_sizes[j]
+            # boundaries are float64, compare a lower precision lens in float64 as well
+            vals = lens_column(M,col)
+            inner_id = np.floor((vals-pre_lbs[j])/bin_size).astype(np.int64)
+            boundary = np.nonzero(vals == pre_ubs[j])[0]
             inner_id[boundary] = nbins-1
-            bin_ids = inner_id
-            for i,bin_id in enumerate(bin_ids):
-                all_assignments[i][j].append(bin_id)
             bin_lbs = []
             bin_ubs = []
             for t in range(nbins):
-                bin_lbs.append(self._compute_bin_lbs(t,overlap[0],j,nbins))
-                bin_ubs.append(self._compute_bin_ubs(t,overlap[1],j,nbins))
+                bin_lbs.append(GTDA._compute_bin_lbs(t,overlap[0],j,nbins,pre_lbs,bin_sizes))
+                bin_ubs.append(GTDA._compute_bin_ubs(t,overlap[1],j,nbins,pre_lbs,bin_sizes))
             bin_lbs = np.array(bin_lbs)
             bin_ubs = np.array(bin_ubs)
-            new_inner_id = inner_id+1
-            valid_ids = np.nonzero((new_inner_id>=0)*(new_inner_id<nbins))[0]
-            valid_bin_ids = new_inner_id[valid_ids]
-            filtered_ids = np.nonzero(M[valid_ids,col] >= bin_lbs[valid_bin_ids])[0]
-            valid_ids = valid_ids[filtered_ids]
-            valid_bin_ids = valid_bin_ids[filtered_ids]
-            for i,valid_id in enumerate(valid_ids):
-                all_assignments[valid_id][j].append(valid_bin_ids[i])
-            new_inner_id = inner_id-1
-            valid_ids = np.nonzero((new_inner_id>=0)*(new_inner_id<nbins))[0]
-            valid_bin_ids = new_inner_id[valid_ids]
-            filtered_ids = np.nonzero(M[valid_ids,col] <= bin_ubs[valid_bin_ids])[0]
-            valid_ids = valid_ids[filtered_ids]
-            valid_bin_ids = valid_bin_ids[filtered_ids]
-            for i,valid_id in enumerate(valid_ids):
-                all_assignments[valid_id][j].append(valid_bin_ids[i])
-        for i in range(M.shape[0]):
-            for bin_key in itertools.product(*all_assignments[i]):
-                if bin_key not in bin_key_map:
-                    bin_key_map[bin_key] = bin_nums
-                    bin_map[bin_nums] = bin_key
-                    bins[bin_nums].append(i)
-                    bin_nums += 1
+            col_ids = np.stack([inner_id,inner_id+1,inner_id-1],1)
+            col_valid = np.ones(col_ids.shape,dtype=bool)
+            for o in [1,2]:
+                valid_ids = np.nonzero((col_ids[:,o]>=0)*(col_ids[:,o]<nbins))[0]
+                if o == 1:
+                    is_in = vals[valid_ids] >= bin_lbs[col_ids[valid_ids,o]]
                 else:
-                    assigned_id = bin_key_map[bin_key]
-                    bins[assigned_id].append(i)
-        return bins,bin_map
+                    is_in = vals[valid_ids] <= bin_ubs[col_ids[valid_ids,o]]
+                col_valid[:,o] = False
+                col_valid[valid_ids[is_in],o] = True
+            offset = np.min(col_ids[col_valid]) if len(cand_samples) > 0 else 0
+            span = np.max(col_ids[col_valid])-offset+1 if len(cand_samples) > 0 else 1
+            new_samples,new_keys,new_ranks = [],[],[]
+            for o in range(3):
+                keep = np.nonzero(col_valid[cand_samples,o])[0]
+                new_samples.append(cand_samples[keep])
+                new_keys.append(cand_keys[keep]*span+col_ids[cand_samples[keep],o]-offset)
+                new_ranks.append(cand_ranks[keep]*3+o)
+            cand_samples = np.concatenate(new_samples)
+            cand_keys = np.concatenate(new_keys)
+            cand_ranks = np.concatenate(new_ranks)
+            order = np.lexsort((cand_ranks,cand_samples))
+            cand_samples = cand_samples[order]
+            cand_keys = cand_keys[order]
+            cand_ranks = cand_ranks[order]
+        bin_keys,first_seen,inverse = np.unique(cand_keys,return_index=True,return_inverse=True)
+        bin_order = np.argsort(first_seen)
+        bin_rank = np.empty(len(bin_order),dtype=np.int64)
+        bin_rank[bin_order] = np.arange(len(bin_order))
+        bin_of_cand = bin_rank[inverse.reshape(-1)]
+        members = cand_samples[np.argsort(bin_of_cand,kind="stable")]
+        indptr = np.zeros(len(bin_order)+1,dtype=np.int64)
+        np.cumsum(np.bincount(bin_of_cand,minlength=len(bin_order)),out=indptr[1:])
+        return (indptr,members),bin_keys[bin_order]
 
-    def filtering(
-        self,M,filter_cols,nbins=2,overlap=(0.05,0.05),**kwargs):
-        self._clustering_single_col_pyramid(M,filter_cols,nbins,**kwargs)
-        return self._find_bins_pyramid(M,filter_cols,overlap,nbins)
+    @staticmethod
+    def filtering(M,filter_cols,nbins=2,overlap=(0.05,0.05),**kwargs):
+        bounds = GTDA._clustering_single_col_pyramid(M,filter_cols,nbins,**kwargs)
+        return GTDA._find_bins_pyramid(M,filter_cols,overlap,nbins,bounds)
 
-    def graph_clustering(self,G,bins,component_size_thd=10):
-        graph_clusters = defaultdict(list)
-        for key in bins.keys():
-            points = bins[key]
-            if len(points) < component_size_thd:
-                continue
-            Gr = G[points,:][:,points].copy()
-            _,components = find_components(Gr,component_size_thd)
-            for component in components:
-                graph_clusters[key].append([points[node] for node in component])
-        return graph_clusters
+    # Returns the clusters CSR-style as (cluster_bins, indptr, members), cluster k being
+    # members[indptr[k]:indptr[k+1]] from bin cluster_bins[k]. With single_pass, nodes in
+    # the overlap of two bins are duplicated and all bins are labeled by one connected
+    # components call over the block-diagonal bin subgraphs.
+    @staticmethod
+    def graph_clustering(G,bins,component_size_thd=10,single_pass=True):
+        indptr,members = bins
+        sizes = np.diff(indptr)
+        keys = np.nonzero(sizes >= component_size_thd)[0]
+        if len(keys) == 0:
+            return np.zeros(0,dtype=np.int64),np.zeros(1,dtype=np.int64),np.zeros(0,dtype=members.dtype)
+        bin_members = members[np.repeat(sizes >= component_size_thd,sizes)]
+        bin_indptr = np.concatenate([[0],np.cumsum(sizes[keys])])
+        bin_subgraphs = group_subgraphs(G,bin_members,bin_indptr)
+        if single_pass:
+            # labels follow the smallest position of each component, so clusters come
+            # out bin by bin in the same order as labeling every bin separately
+            _,cluster_indptr,positions = find_components_array(
+                block_diagonal(bin_subgraphs,bin_indptr),size_thd=component_size_thd)
+            cluster_bins = np.repeat(keys,sizes[keys])[positions[cluster_indptr[:-1]]]
+            return cluster_bins,cluster_indptr,bin_members[positions]
+        cluster_bins,cluster_sizes,cluster_members = [],[],[]
+        for i,key in enumerate(keys):
+            points = bin_members[bin_indptr[i]:bin_indptr[i+1]]
+            Gr = group_subgraph(bin_subgraphs,bin_indptr,i)
+            _,component_indptr,components = find_components_array(Gr,component_size_thd)
+            cluster_bins.append(np.full(len(component_indptr)-1,key))
+            cluster_sizes.append(np.diff(component_indptr))
+            cluster_members.append(points[components])
+        cluster_indptr = np.concatenate([[0],np.cumsum(np.concatenate(cluster_sizes))])
+        return np.concatenate(cluster_bins),cluster_indptr,np.concatenate(cluster_members)
 
     def find_reeb_nodes(self,M,Ar,
         filter_cols=None,nbins_pyramid=2,overlap=(0.5,0.5),node_size_thd=10,
-        smallest_component=50,component_size_thd=0,split_criteria="diff",split_thd=0.01,max_iters=50,verbose=False):
-        self.component_records_all = {}
-        self.final_components_all = {}
-        self.component_records = {}
-        self.final_components = {}
-        self.component_counts = [0]
-        self.split_lens = {}
-        self.component_id_map = defaultdict(list)
-        _,components = find_components(Ar,size_thd=0)
-        curr_level = []
-        num_final_components = 0
-        num_total_components = 0
-        for component in components:
-            self.component_records[num_total_components] = component
-            if len(component) > smallest_component:
-                curr_level.append(num_total_components)
-            else:
-                self.final_components[num_final_components] = component
-                num_final_components += 1
-            num_total_components += 1
-        self.component_counts.append(len(self.component_records))
-        iters = 0
-        def worker(M_sub,G_sub,component_id,nbins_pyramid,overlap,component_size_thd,
-            split_thd):
-            if split_criteria == 'std':
-                diffs = np.std(M_sub,0)
-            else:
-                diffs = np.max(M_sub,0) - np.min(M_sub,0)
-            col_to_filter = np.argmax(diffs)
-            largest_diff = diffs[col_to_filter]
-            if largest_diff < split_thd:
-                return [list(range(M_sub.shape[0]))],component_id,largest_diff,col_to_filter
-            else:
-                bins,_ = self.filtering(
-                    M_sub,[col_to_filter],nbins=nbins_pyramid,overlap=overlap)
-                graph_clusters = self.graph_clustering(G_sub,bins,
-                        component_size_thd=component_size_thd)
-                return graph_clusters,component_id,largest_diff,col_to_filter
-        slice_columns = True
-        if len(np.setdiff1d(range(M.shape[1]),filter_cols)) == 0:
-            slice_columns = False
-        while len(curr_level) > 0 and iters < max_iters:
-            iters += 1
-            if verbose:
-                print(f"Iteration {iters}")
-                print(f"{len(curr_level)} components to split")
-            sizes = []
-            new_level = []
-            all_G_sub = []
-            all_M_sub = []
-            t1 = time.time()
-            for component_id in curr_level:
-                component = np.array(self.component_records[component_id])
-                G_sub = Ar[component,:][:,component].copy()
-                if slice_columns:
-                    M_sub = M[component,:][:,filter_cols].copy()
+        smallest_component=50,component_size_thd=0,split_criteria="diff",split_thd=0.01,max_iters=50,
+        nprocs=1,backend="threading",verbose=False):
+        with self.profiler.stage("find_reeb_nodes") as stage:
+            self.component_records_all = {}
+            self.final_components_all = {}
+            index_dtype = get_index_dtype(Ar.shape[0],self.index_dtype)
+            self.component_records = ComponentStore(dtype=index_dtype)
+            self.final_components = ComponentStore(dtype=index_dtype)
+            self.component_counts = [0]
+            self.split_lens = {}
+            self.component_id_map = defaultdict(list)
+            _,indptr,members = find_components_array(Ar,size_thd=0)
+            curr_level = []
+            num_final_components = 0
+            num_total_components = 0
+            for i in range(len(indptr)-1):
+                component = members[indptr[i]:indptr[i+1]]
+                self.component_records[num_total_components] = component
+                if len(component) > smallest_component:
+                    curr_level.append(num_total_components)
                 else:
-                    M_sub = M[component,:].copy()
-                all_G_sub.append(G_sub)
-                all_M_sub.append(M_sub)
-            t2 = time.time()
-            if verbose:
-                print(f"Grouping took {t2-t1} seconds")
-            process_order = sorted([(-1*all_M_sub[i].shape[0],i) for i in range(len(all_M_sub))])
-            t1 = time.time()
-            min_largest_diff = float("inf")
-            max_largest_diff = -1*float("inf")
-            for _,i in process_order:
-                ret = worker(
-                    all_M_sub[i],all_G_sub[i],curr_level[i],
-                    nbins_pyramid,overlap,component_size_thd,split_thd)
-                graph_clusters,component_id,largest_diff,col_to_filter = ret
-                min_largest_diff = min(min_largest_diff,largest_diff)
-                max_largest_diff = max(max_largest_diff,largest_diff)
-                self.split_lens[component_id] = col_to_filter
-                component = np.array(self.component_records[component_id])
-                if largest_diff < split_thd:
-                    self.final_components[num_final_components] = component.tolist()
+                    self.final_components[num_final_components] = component
                     num_final_components += 1
-                    num_total_components += 1
-                    sizes.append(len(component))
-                else:
-                    for components in graph_clusters.values():
-                        for new_component in components:
-                            sizes.append(len(new_component))
-                            self.component_records[num_total_components] = component[new_component].tolist()
-                            self.component_id_map[component_id].append(num_total_components)
-                            if (len(new_component) > smallest_component):
-                                new_level.append(num_total_components)
-                            else:
-                                self.final_components[num_final_components] = component[new_component].tolist()
-                                num_final_components += 1
-                            num_total_components += 1
-            if verbose:
-                print(f"Min/max largest difference: {min_largest_diff}, {max_largest_diff}")
-                print("New components sizes:")
-                print(Counter(sizes))
-            curr_level = new_level
-            t2 = time.time()
-            if verbose:
-                print(f"Splitting took {t2-t1} seconds")
+                num_total_components += 1
             self.component_counts.append(len(self.component_records))
-        if len(curr_level) > 0:
-            if iters >= max_iters:
-                warnings.warn("Stopped early, try increasing max number of iterations for splitting")
-            for i in curr_level:
-                self.final_components[num_final_components] = self.component_records[i]
-                num_final_components += 1
-        self._remove_duplicate_components()
-        self._filter_tiny_components(Ar,node_size_thd,verbose)
+            iters = 0
+            slice_columns = True
+            if len(np.setdiff1d(range(M.shape[1]),filter_cols)) == 0:
+                slice_columns = False
+            while len(curr_level) > 0 and iters < max_iters:
+                iters += 1
+                if verbose:
+                    print(f"Iteration {iters}")
+                    print(f"{len(curr_level)} components to split")
+                sizes = []
+                new_level = []
+                with self.profiler.stage("split_level",level=iters,components=len(curr_level)) as level_stage:
+                    t1 = time.time()
+                    # lay the live components out contiguously, each one is then a range of the
+                    # level layout and its subgraph and lens block are views instead of copies
+                    level_indptr,level_members = self.component_records.gather(curr_level)
+                    level_subgraphs = group_subgraphs(Ar,level_members,level_indptr)
+                    if slice_columns and sp.issparse(M):
+                        M_level = M[level_members,:][:,filter_cols]
+                    elif slice_columns:
+                        M_level = M[np.ix_(level_members,filter_cols)]
+                    else:
+                        M_level = M[level_members,:]
+                    # column statistics of all components of the level at once, one row per component
+                    if split_criteria == 'std':
+                        diffs = segment_std(M_level,level_indptr)
+                    else:
+                        lbs,ubs = segment_min_max(M_level,level_indptr)
+                        diffs = ubs-lbs
+                    if M_level.dtype == np.float64:
+                        level_cols = row_argmax(diffs)
+                    else:
+                        # in lower precision, columns within rounding error of the largest one are tied and like
+                        # np.argmax ties go to the first of them, complementary lenses such as p and 1-p then
+                        # pick the same column as in float64
+                        level_cols = row_argmax(diffs,rtol=64*np.finfo(M_level.dtype).eps)
+                    largest_diffs = lens_values(diffs,np.arange(len(curr_level)),level_cols)
+                    level_sizes = np.diff(level_indptr)
+                    # lens values are only gathered for the components that will be split
+                    to_split = np.nonzero(np.repeat(largest_diffs >= split_thd,level_sizes))[0]
+                    level_vals = np.zeros(len(level_members),dtype=M_level.dtype)
+                    level_vals[to_split] = lens_values(M_level,to_split,np.repeat(level_cols,level_sizes)[to_split])
+                    self.profiler.count("subgraph_extractions",len(curr_level))
+                    self.profiler.count("bytes_copied",int(
+                        level_members.nbytes+lens_nbytes(M_level)+level_vals.nbytes+sum(x.nbytes for x in level_subgraphs)))
+                    t2 = time.time()
+                    if verbose:
+                        print(f"Grouping took {t2-t1} seconds")
+                    process_order = sorted([(-1*level_sizes[i],i) for i in range(len(curr_level))])
+                    t1 = time.time()
+                    min_largest_diff = float("inf")
+                    max_largest_diff = -1*float("inf")
+                    # components of a level are independent, split them concurrently and
+                    # consume the results in process_order so component ids match a serial run
+                    # split columns are picked for the whole level beforehand, workers take every nprocs-th
+                    # component of process_order, which balances their sizes
+                    order = [i for _,i in process_order]
+                    if nprocs == 1 or len(to_split) < self.parallel_min_samples:
+                        chunks = [order]
+                    else:
+                        chunks = [chunk for chunk in [order[c::nprocs] for c in range(nprocs)] if len(chunk) > 0]
+                    tasks = [(level_vals,level_subgraphs,level_indptr,chunk,[curr_level[i] for i in chunk],
+                        largest_diffs[chunk],level_cols[chunk],nbins_pyramid,overlap,component_size_thd,split_thd)
+                        for chunk in chunks]
+                    if len(tasks) == 1:
+                        chunk_results = [split_components(*tasks[0])]
+                    else:
+                        chunk_results = Parallel(n_jobs=nprocs,backend=backend)(
+                            delayed(split_components)(*task) for task in tasks)
+                    processed = {}
+                    for chunk,results in zip(chunks,chunk_results):
+                        processed.update(zip(chunk,results))
+                    processed_list = [processed[i] for i in order]
+                    for ret in processed_list:
+                        graph_clusters,component_id,largest_diff,col_to_filter = ret
+                        min_largest_diff = min(min_largest_diff,largest_diff)
+                        max_largest_diff = max(max_largest_diff,largest_diff)
+                        self.split_lens[component_id] = col_to_filter
+                        component = self.component_records.members(component_id)
+                        if largest_diff < split_thd:
+                            self.final_components[num_final_components] = component
+                            num_final_components += 1
+                            num_total_components += 1
+                            sizes.append(len(component))
+                        else:
+                            _,cluster_indptr,cluster_members = graph_clusters
+                            for k in range(len(cluster_indptr)-1):
+                                new_component = component[cluster_members[cluster_indptr[k]:cluster_indptr[k+1]]]
+                                sizes.append(len(new_component))
+                                self.component_records[num_total_components] = new_component
+                                self.component_id_map[component_id].append(num_total_components)
+                                if (len(new_component) > smallest_component):
+                                    new_level.append(num_total_components)
+                                else:
+                                    self.final_components[num_final_components] = new_component
+                                    num_final_components += 1
+                                num_total_components += 1
+                    if verbose:
+                        print(f"Min/max largest difference: {min_largest_diff}, {max_largest_diff}")
+                        print("New components sizes:")
+                        print(Counter(sizes))
+                    curr_level = new_level
+                    t2 = time.time()
+                    if verbose:
+                        print(f"Splitting took {t2-t1} seconds")
+                    self.component_counts.append(len(self.component_records))
+                    level_stage["info"].update(new_components=len(sizes),next_level=len(curr_level))
+            if len(curr_level) > 0:
+                if iters >= max_iters:
+                    warnings.warn("Stopped early, try increasing max number of iterations for splitting")
+                for i in curr_level:
+                    self.final_components[num_final_components] = self.component_records.members(i)
+                    num_final_components += 1
+            self._remove_duplicate_components()
+            self._filter_tiny_components(Ar,node_size_thd,verbose)
+            stage["info"].update(
+                levels=iters,final_components=len(self.final_components),
+                unique_components=len(self.final_components_unique),filtered_components=len(self.final_components_filtered))
     
     def _remove_duplicate_components(self):
-        all_c = sorted([
-            sorted(self.final_components[key]) for key in self.final_components.keys()])
-        filtered_c = list(k for k,_ in itertools.groupby(all_c))
-        self.final_components_unique = {i:c for i,c in enumerate(filtered_c)}
+        self.final_components_unique = self.final_components.unique()
 
 
     def _filter_tiny_components(self,Ar,node_size_thd,verbose):
-        nodes = []
-        for val in self.final_components_unique.values():
-            nodes += val
         if verbose:
-            print("Number of samples included before filtering:", len(set(nodes)))
-        all_keys = self.final_components_unique.keys()
-        filtered_keys = []
-        removed_keys = []
-        self.node_assignments = [set() for i in range(Ar.shape[0])]
-        self.node_assignments_tiny_components = [set() for i in range(Ar.shape[0])]
-        for key in all_keys:
-            if len(self.final_components_unique[key]) > node_size_thd:
-                for node in self.final_components_unique[key]:
-                    self.node_assignments[node].add(key)
-                filtered_keys.append(key)
-            else:
-                for node in self.final_components_unique[key]:
-                    self.node_assignments_tiny_components[node].add(key)
-                removed_keys.append(key)
-        self.final_components_removed = {
-            key:self.final_components_unique[key] for key in removed_keys}
-        self.final_components_filtered = {
-            key:self.final_components_unique[key] for key in filtered_keys}
-        nodes = []
-        for val in self.final_components_filtered.values():
-            nodes += val
-        nodes = list(set(nodes))
+            print("Number of samples included before filtering:",
+                len(np.unique(self.final_components_unique.gather()[1])))
+        all_keys = np.array(list(self.final_components_unique.keys()),dtype=np.int64)
+        is_filtered = self.final_components_unique.sizes(all_keys) > node_size_thd
+        filtered_keys = all_keys[is_filtered].tolist()
+        removed_keys = all_keys[~is_filtered].tolist()
+        nnodes = int(all_keys.max())+1 if len(all_keys) > 0 else 0
+        self.node_assignments = NodeAssignments.from_components(
+            self.final_components_unique,filtered_keys,Ar.shape[0],nnodes)
+        self.node_assignments_tiny_components = NodeAssignments.from_components(
+            self.final_components_unique,removed_keys,Ar.shape[0],nnodes)
+        self.final_components_removed = self.final_components_unique.subset(removed_keys)
+        self.final_components_filtered = self.final_components_unique.subset(filtered_keys)
         if verbose:
-            print("Number of samples included after filtering:", len(nodes))
+            print("Number of samples included after filtering:",
+                len(np.unique(self.final_components_filtered.gather()[1])))
 
+    # For each sample the smallest reeb node containing it, -1 if there is none. Ties go to filtered
+    # nodes before tiny ones and among them to the smallest key.
+    def _smallest_components_containing(self,samples,include_tiny=True):
+        assignments = [self.node_assignments]
+        if include_tiny:
+            assignments.append(self.node_assignments_tiny_components)
+        segments,candidates = [],[]
+        for assignment in assignments:
+            indptr,nodes = assignment.nodes_of(samples)
+            segments.append(np.repeat(np.arange(len(samples)),np.diff(indptr)))
+            candidates.append(nodes)
+        segments = np.concatenate(segments)
+        candidates = np.concatenate(candidates)
+        sizes = np.zeros(self.node_assignments.nnodes,dtype=np.int64)
+        for store in [self.final_components_removed,self.final_components_filtered]:
+            keys = list(store.keys())
+            sizes[keys] = store.sizes(keys)
+        order = np.lexsort((np.arange(len(candidates)),sizes[candidates],segments))
+        first = order[np.r_[True,segments[order][1:] != segments[order][:-1]]] if len(order) > 0 else order
+        smallest = np.full(len(samples),-1,dtype=np.int64)
+        smallest[segments[first]] = candidates[first]
+        return smallest
+
+    # merging runs in the calling process, nprocs is accepted for compatibility and ignored
     def merge_reeb_nodes(self,Ar,M,niters=1,node_size_thd=10,edges_dists=None,nprocs=10,verbose=False):
-        num_components = len(self.final_components_filtered)+len(self.final_components_removed)
-        def worker(tmp_edges_dists,nodes,k1):
-            closest_neigh = -1
-            neighs = tmp_edges_dists.indices
-            valid_neighs = np.setdiff1d(neighs,nodes)
-            tmp_edges_dists = tmp_edges_dists[:,valid_neighs]
-            if tmp_edges_dists.data.shape[0] > 0:
-                closest_neigh_id = np.argmin(tmp_edges_dists.data)
-                closest_neigh = tmp_edges_dists.indices[closest_neigh_id]
-                closest_neigh = valid_neighs[closest_neigh]
-            return closest_neigh,k1
-        modified = True
-        self.edges_to_merge = []
-        print("Merge reeb nodes...")
-        for _ in range(niters):
-            if modified:
-                modified = False
-            else:
-                break
-            merging_ei = []
-            merging_ej = []
-            keys_to_check = self.final_components_removed.keys()
-            processed_list = Parallel(n_jobs=nprocs)(
-                delayed(worker)(
-                    edges_dists[self.final_components_removed[k1],:],
-                    self.final_components_removed[k1],k1) for k1 in tqdm(keys_to_check,disable=1-verbose))
-            for closest_neigh,k1 in processed_list:
-                if closest_neigh != -1:
-                    components_to_connect = list(self.node_assignments[closest_neigh])+list(self.node_assignments_tiny_components[closest_neigh])
-                    if len(components_to_connect) > 0:
-                        sizes = []
-                        for c in components_to_connect:
-                            if c in self.final_components_filtered:
-                                sizes.append(len(self.final_components_filtered[c]))
-                            else:
-                                sizes.append(len(self.final_components_removed[c]))
-                        component_to_connect = components_to_connect[np.argmin(sizes)]
-                        merging_ei.append(component_to_connect)
-                        merging_ej.append(k1)
-                        self.edges_to_merge.append((component_to_connect,k1))
-                        modified = True
-            merging_map = sp.csr_matrix((np.ones(len(merging_ei)),(merging_ei,merging_ej)),shape=(num_components,num_components))
-            merging_map = (merging_map+merging_map.T)>0
-            self._merging_tiny_nodes(merging_map,node_size_thd,verbose)
+        with self.profiler.stage("merge_reeb_nodes") as stage:
+            num_components = self.node_assignments.nnodes
+            if not isinstance(edges_dists,NeighborIndex):
+                edges_dists = NeighborIndex(edges_dists)
+            modified = True
+            self.edges_to_merge = []
+            print("Merge reeb nodes...")
+            for _ in range(niters):
+                if modified:
+                    modified = False
+                else:
+                    break
+                k1s = np.array(list(self.final_components_removed.keys()),dtype=np.int64)
+                indptr,members = self.final_components_removed.gather(k1s)
+                closest_neighs,_ = edges_dists.nearest_outside(members,indptr)
+                found = closest_neighs != -1
+                components_to_connect = self._smallest_components_containing(closest_neighs[found])
+                connected = components_to_connect != -1
+                merging_ei = components_to_connect[connected].tolist()
+                merging_ej = k1s[found][connected].tolist()
+                self.edges_to_merge += list(zip(merging_ei,merging_ej))
+                modified = len(merging_ei) > 0
+                merging_map = sp.csr_matrix((np.ones(len(merging_ei)),(merging_ei,merging_ej)),shape=(num_components,num_components))
+                merging_map = (merging_map+merging_map.T)>0
+                self._merging_tiny_nodes(merging_map,node_size_thd,verbose)
+                self.profiler.count("merge_iterations")
+            stage["info"].update(
+                merged_edges=len(self.edges_to_merge),filtered_components=len(self.final_components_filtered))
     
+    # distinct samples in ascending order, shards keep the samples of a graph in ascending order as well
+    def _set_members(self,samples):
+        return np.unique(np.asarray(samples,dtype=np.int64)).tolist()
+
+    # Members of merged reeb nodes are kept in ascending order, nearest neighbor ties during later
+    # merges and reconnection go to the smallest sample.
     def _merging_tiny_nodes(self,merging_map,node_size_thd,verbose):
         keys_to_remove = set()
-        components_to_merge = find_components(merging_map,size_thd=1)[1]
-        for component_to_merge in components_to_merge:
+        # (nodes, key, added) in the order the updates are made
+        filtered_updates,tiny_updates = [],[]
+        _,merge_indptr,merge_members = find_components_array(merging_map,size_thd=1)
+        for i in range(len(merge_indptr)-1):
+            component_to_merge = merge_members[merge_indptr[i]:merge_indptr[i+1]].tolist()
             component_to_connect = component_to_merge[0]
             for k in component_to_merge:
                 if k in self.final_components_filtered:
@@ -366,223 +496,194 @@ class GTDA(object):
             for k in component_to_merge:
                 if k == component_to_connect:
                     continue
-                nodes = self.final_components_removed[k]
+                nodes = self.final_components_removed.members(k)
                 if component_to_connect in self.final_components_filtered:
-                    self.final_components_filtered[component_to_connect] += nodes
-                    self.final_components_filtered[component_to_connect] = list(set(self.final_components_filtered[component_to_connect]))
+                    self.final_components_filtered[component_to_connect] = self._set_members(
+                        self.final_components_filtered[component_to_connect]+nodes.tolist())
                     keys_to_remove.add(k)
-                    for node in nodes:
-                        self.node_assignments[node].add(component_to_connect)
-                        self.node_assignments_tiny_components[node].remove(k)
+                    filtered_updates.append((nodes,component_to_connect,True))
+                    tiny_updates.append((nodes,k,False))
                 else:
-                    new_component += nodes
+                    new_component += nodes.tolist()
             if component_to_connect not in self.final_components_filtered:
                 new_component += self.final_components_removed[component_to_connect]
-                new_component = list(set(new_component))
+                new_component = self._set_members(new_component)
                 if len(new_component) > node_size_thd:
                     for k in component_to_merge:
-                        nodes = self.final_components_removed[k]
+                        nodes = self.final_components_removed.members(k)
                         keys_to_remove.add(k)
-                        for node in nodes:
-                            self.node_assignments[node].add(component_to_connect)
-                            self.node_assignments_tiny_components[node].remove(k)
+                        filtered_updates.append((nodes,component_to_connect,True))
+                        tiny_updates.append((nodes,k,False))
                     self.final_components_filtered[component_to_connect] = new_component
                 else:
                     for k in component_to_merge:
-                        nodes = self.final_components_removed[k]
+                        nodes = self.final_components_removed.members(k)
                         if k != component_to_connect:
                             keys_to_remove.add(k)
-                        for node in nodes:
-                            self.node_assignments_tiny_components[node].remove(k)
-                            self.node_assignments_tiny_components[node].add(component_to_connect)
+                        tiny_updates.append((nodes,k,False))
+                        tiny_updates.append((nodes,component_to_connect,True))
                     self.final_components_removed[component_to_connect] = new_component
+        for assignment,updates in [
+            (self.node_assignments_tiny_components,tiny_updates),(self.node_assignments,filtered_updates)]:
+            if len(updates) > 0:
+                assignment.update(
+                    np.concatenate([nodes for nodes,_,_ in updates]),
+                    np.concatenate([np.full(len(nodes),k) for nodes,k,_ in updates]),
+                    np.concatenate([np.full(len(nodes),added) for nodes,_,added in updates]))
         for k in keys_to_remove:
             del self.final_components_removed[k]
-        nodes = []
-        for val in self.final_components_filtered.values():
-            nodes += val
-        nodes = list(set(nodes))
         if verbose:
-            print("Number of samples included after merging:", len(nodes))
+            print("Number of samples included after merging:",
+                len(np.unique(self.final_components_filtered.gather()[1])))
     
+    # g_reeb is still accepted in its place but ignored, node statistics no longer use the reeb graph
     def generate_node_info(
-        self,nn_model,Ar,g_reeb,extra_edges=None,class_colors=None,alpha=0.5,nsteps=10,
-        pre_labels=None,known_nodes=None,degree_normalize=1):
-        if known_nodes is None:
-            known_mask_np = nn_model.train_mask+nn_model.val_mask
-            known_nodes = np.nonzero(known_mask_np)[0]
-        else:
-            known_mask_np = np.zeros(Ar.shape[0],dtype=bool)
-            known_mask_np[known_nodes] = True
-        labels = nn_model.labels
-        if pre_labels is None:
-            pre_labels = np.argmax(nn_model.preds,1)
-        max_key = np.max(list(self.final_components_filtered.keys()))
-        self.node_sizes = np.zeros(max_key+1)
-        self.node_colors_class = np.zeros((max_key+1,nn_model.preds.shape[1]))
-        self.node_colors_class_truth = np.zeros((max_key+1,nn_model.preds.shape[1]))
-        self.node_colors_error = np.zeros(max_key+1)
-        self.node_colors_uncertainty = np.zeros(max_key+1)
-        self.node_colors_mixing = np.zeros(max_key+1)
-        self.sample_colors_mixing = np.zeros(nn_model.preds.shape[0])
-        uncertainty = 1-np.max(nn_model.preds,1)
-        self.sample_colors_uncertainty = uncertainty
-        self.sample_colors_error = np.zeros(nn_model.preds.shape[0])
-        if class_colors is None:
-            class_colors = sns.color_palette(n_colors=nn_model.preds.shape[1])
-        reeb_components = find_components(g_reeb,size_thd=0)[1]
-        ei,ej = [],[]
-        for reeb_component in reeb_components:
-            for reeb_node in reeb_component:
-                if reeb_node in self.final_components_filtered:
-                    nodes = self.final_components_filtered[reeb_node]
-                    nodes = list(set(nodes))
-                    mapping = {i:k for i,k in enumerate(nodes)}
-                    sub_A = Ar[nodes,:][:,nodes].tocoo()
-                    for i,j in zip(sub_A.row,sub_A.col):
-                        ei.append(mapping[i])
-                        ej.append(mapping[j])
-        if extra_edges is not None:
-            ei += extra_edges[0]
-            ej += extra_edges[1]
-        self.A_reeb = sp.csr_matrix((np.ones(len(ei)),(ei,ej)),shape=Ar.shape)
-        self.A_reeb = self.A_reeb+self.A_reeb.T
-        self.A_reeb = (self.A_reeb>0).astype(int)
-        training_node_labels = np.zeros((Ar.shape[0],nn_model.preds.shape[1]))
-        for node in known_nodes:
-            training_node_labels[node,labels[node]] = 1
-        degs = np.sum(Ar,0)
-        dinv = 1/degs
-        dinv[dinv==np.inf] = 0
-        Dinv = sp.spdiags(dinv,0,Ar.shape[0],Ar.shape[0])
-        degs = np.sum(self.A_reeb,0)
-        dinv = 1/degs
-        dinv[dinv==np.inf] = 0
-        Dinv = sp.spdiags(dinv,0,self.A_reeb.shape[0],self.A_reeb.shape[0])
-        if degree_normalize == 1:
-            self.An = Dinv@self.A_reeb
-        elif degree_normalize == 2:
-            self.An = self.A_reeb@Dinv
-        elif degree_normalize == 3:
-            self.An = np.sqrt(Dinv)@self.A_reeb@np.sqrt(Dinv)
-        else:
-            self.An = self.A_reeb
-        self.total_mixing_all = np.copy(training_node_labels)
-        for i in range(nsteps):
-            self.total_mixing_all = (1-alpha)*training_node_labels + alpha*self.An@self.total_mixing_all
-        for i in range(self.total_mixing_all.shape[0]):
-            if np.sum(self.total_mixing_all[i,:]) > 0:
-                d = self.total_mixing_all[i,pre_labels[i]]/np.sum(self.total_mixing_all[i,:])
-                self.sample_colors_mixing[i] = 1-d
+        self,nn_model,Ar,g_reeb=None,extra_edges=None,class_colors=None,alpha=0.5,nsteps=10,
+        pre_labels=None,known_nodes=None,degree_normalize=1,tol=None,method="power",nthreads=1):
+        with self.profiler.stage("generate_node_info") as stage:
+            if known_nodes is None:
+                known_mask_np = nn_model.train_mask+nn_model.val_mask
+                known_nodes = np.nonzero(known_mask_np)[0]
             else:
-                self.sample_colors_mixing[i] = uncertainty[i]
-            self.sample_colors_error[i] = 1-(pre_labels[i]==labels[i])
-            self.sample_colors_uncertainty[i] = uncertainty[i]
-        for key in self.final_components_filtered.keys():
-            component = np.array(self.final_components_filtered[key])
-            self.node_sizes[key] = len(component)
-            component_label_cnt = Counter(labels[component])
-            for l,lc in component_label_cnt.items():
-                self.node_colors_class_truth[key,l] = lc
-            component_label_cnt = Counter(pre_labels[component])
-            for l,lc in component_label_cnt.items():
-                self.node_colors_class[key,l] = lc
-            if len(component) > 0:
-                self.node_colors_error[key] = np.mean(self.sample_colors_error[component])
-                self.node_colors_uncertainty[key] = np.mean(self.sample_colors_uncertainty[component])
-                self.node_colors_mixing[key] = np.mean(self.sample_colors_mixing[component])
+                known_mask_np = np.zeros(Ar.shape[0],dtype=bool)
+                known_mask_np[known_nodes] = True
+            labels = nn_model.labels
+            if pre_labels is None:
+                pre_labels = row_argmax(nn_model.preds)
+            max_key = np.max(list(self.final_components_filtered.keys()))
+            self.node_sizes = np.zeros(max_key+1)
+            self.node_colors_class = np.zeros((max_key+1,nn_model.preds.shape[1]))
+            self.node_colors_class_truth = np.zeros((max_key+1,nn_model.preds.shape[1]))
+            self.node_colors_error = np.zeros(max_key+1)
+            self.node_colors_uncertainty = np.zeros(max_key+1)
+            self.node_colors_mixing = np.zeros(max_key+1)
+            self.sample_colors_mixing = np.zeros(nn_model.preds.shape[0])
+            uncertainty = 1-row_max(nn_model.preds)
+            self.sample_colors_uncertainty = uncertainty
+            self.sample_colors_error = np.zeros(nn_model.preds.shape[0])
+            if class_colors is None:
+                class_colors = sns.color_palette(n_colors=nn_model.preds.shape[1])
+            # edges of Ar whose endpoints share at least one filtered reeb node
+            assignments = NodeAssignments.from_components(
+                self.final_components_filtered,list(self.final_components_filtered.keys()),Ar.shape[0],max_key+1)
+            Ar_coo = Ar.tocoo()
+            within = assignments.share_node(Ar_coo.row,Ar_coo.col)
+            ei,ej = Ar_coo.row[within],Ar_coo.col[within]
+            if extra_edges is not None:
+                ei = np.r_[ei,np.asarray(extra_edges[0],dtype=np.int64)]
+                ej = np.r_[ej,np.asarray(extra_edges[1],dtype=np.int64)]
+            self.A_reeb = sp.csr_matrix((np.ones(len(ei)),(ei,ej)),shape=Ar.shape)
+            self.A_reeb = self.A_reeb+self.A_reeb.T
+            self.A_reeb = (self.A_reeb>0).astype(int if self.index_dtype is None else self.index_dtype)
+            if sp.issparse(self.preds):
+                training_node_labels = sp.csr_matrix(
+                    (np.ones(len(known_nodes),dtype=self.dtype),(known_nodes,np.asarray(labels)[known_nodes])),
+                    shape=(Ar.shape[0],nn_model.preds.shape[1]))
+            else:
+                training_node_labels = np.zeros((Ar.shape[0],nn_model.preds.shape[1]),dtype=self.dtype)
+                training_node_labels[known_nodes,np.asarray(labels)[known_nodes]] = 1
+            self.reeb_operator = GraphOperator(self.A_reeb,dtype=self.dtype,nthreads=nthreads)
+            self.mixing_degree_normalize = degree_normalize
+            self.total_mixing_all,self.mixing_diffusion_info = diffuse(
+                self.reeb_operator,training_node_labels,alpha=alpha,nsteps=nsteps,degree_normalize=degree_normalize,
+                tol=tol,method=method)
+            mixing_sums = np.asarray(self.total_mixing_all.sum(1)).reshape(-1)
+            has_mixing = mixing_sums > 0
+            predicted_mixing = np.asarray(self.total_mixing_all[np.arange(len(pre_labels)),pre_labels]).reshape(-1)
+            self.sample_colors_mixing[has_mixing] = 1-predicted_mixing[has_mixing]/mixing_sums[has_mixing]
+            self.sample_colors_mixing[~has_mixing] = uncertainty[~has_mixing]
+            self.sample_colors_error[:] = 1-(pre_labels==labels)
+            # per node statistics as bincounts over the (node, sample) pairs of filtered nodes
+            keys = list(self.final_components_filtered.keys())
+            indptr,members = self.final_components_filtered.gather(keys)
+            rows = np.repeat(np.asarray(keys,dtype=np.int64),np.diff(indptr))
+            nclasses = nn_model.preds.shape[1]
+            self.node_sizes[:] = np.bincount(rows,minlength=max_key+1)
+            self.node_colors_class_truth[:] = np.bincount(
+                rows*nclasses+labels[members],minlength=(max_key+1)*nclasses).reshape(-1,nclasses)
+            self.node_colors_class[:] = np.bincount(
+                rows*nclasses+pre_labels[members],minlength=(max_key+1)*nclasses).reshape(-1,nclasses)
+            nonempty = self.node_sizes > 0
+            for node_colors,sample_colors in [
+                (self.node_colors_error,self.sample_colors_error),
+                (self.node_colors_uncertainty,self.sample_colors_uncertainty),
+                (self.node_colors_mixing,self.sample_colors_mixing)]:
+                node_colors[nonempty] = np.bincount(
+                    rows,weights=sample_colors[members],minlength=max_key+1)[nonempty]/self.node_sizes[nonempty]
+            stage["info"].update(self.mixing_diffusion_info)
     
                
-    def build_reeb_graph(self,M,Ar,reeb_component_thd=10,max_iters=10,is_merging=True,edges_dists=None,verbose=False):
-        all_edge_index = [[], []]
-        extra_edges = [[],[]]
-        print("Build reeb graph...")
-        reeb_dim = np.max(list(self.final_components_filtered.keys()))+1
-        ei,ej = [],[]
-        for key,c in self.final_components_filtered.items():
-            ei += [key]*len(c)
-            ej += c
-        bipartite_g = sp.csr_matrix((np.ones(len(ei)),(ei,ej)),shape=(reeb_dim,M.shape[0]))
-        bipartite_g_t = bipartite_g.T.tocsr()
-        ei,ej = [],[]
-        for i in tqdm(self.final_components_filtered.keys(),disable=1-verbose):
-            neighs = set(bipartite_g_t[bipartite_g[i,:].indices].indices)
-            neighs.remove(i)
-            neighs = list(neighs)
-            all_edge_index[0] += [i]*len(neighs)
-            all_edge_index[1] += neighs
-        A_tmp = sp.csr_matrix(
-            (np.ones(len(all_edge_index[1])),(all_edge_index[0],all_edge_index[1])),shape=(
-                reeb_dim,reeb_dim))
-        A_tmp = ((A_tmp+A_tmp.T)>0).astype(np.float64)
-        _,components_left1 = find_components(A_tmp,size_thd=0)
-        components_removed = []
-        self.filtered_nodes = []
-        for c in components_left1:
-            if len(c) > reeb_component_thd:
-                self.filtered_nodes += c
-            else:
-                for node in c:
-                    if node in self.final_components_filtered:
-                        components_removed.append(c)
-                        break
-        curr_iter = 0
-        modified = True
-        while modified and is_merging and len(components_removed) > 0 and curr_iter < max_iters:
-            modified = False
-            curr_iter += 1
-            for component_removed in tqdm(components_removed,disable=1-verbose):
-                nodes_removed = []
-                for key in component_removed:
-                    nodes_removed += self.final_components_filtered[key]
-                tmp_edges_dists = edges_dists[nodes_removed]
-                neighs = tmp_edges_dists.indices
-                valid_neighs = np.setdiff1d(neighs,nodes_removed)
-                tmp_edges_dists = tmp_edges_dists[:,valid_neighs]
-                key_to_connect = -1
-                closest_neigh = -1
-                if tmp_edges_dists.data.shape[0] > 0:
-                    closest_neigh_id = np.argmin(tmp_edges_dists.data)
-                    closest_neigh = tmp_edges_dists.indices[closest_neigh_id]
-                    closest_neigh = valid_neighs[closest_neigh]
-                    node_to_connect = nodes_removed[bisect_right(tmp_edges_dists.indptr,closest_neigh_id)-1]
-                    key_to_connect = np.min(list(self.node_assignments[node_to_connect].intersection(component_removed)))
-                if closest_neigh != -1:
-                    components_to_connect = list(self.node_assignments[closest_neigh])
-                    if len(components_to_connect) > 0:
-                        sizes = []
-                        for c in components_to_connect:
-                            if c in self.final_components_filtered:
-                                sizes.append(len(self.final_components_filtered[c]))
-                            else:
-                                sizes.append(len(self.final_components_removed[c]))
-                        component_to_connect = components_to_connect[np.argmin(sizes)]
-                        all_edge_index[0].append(key_to_connect)
-                        all_edge_index[1].append(component_to_connect)
-                        extra_edges[0].append(node_to_connect)
-                        extra_edges[1].append(closest_neigh)
-                        modified = True
-            A_tmp = sp.csr_matrix(
-                (np.ones(len(all_edge_index[1])),(all_edge_index[0],all_edge_index[1])),shape=(
-                    reeb_dim,reeb_dim))
-            A_tmp = ((A_tmp+A_tmp.T)>0).astype(np.float64)
-            _,components_left1 = find_components(A_tmp,size_thd=0)
-            components_removed = []
-            self.filtered_nodes = []
-            for c in components_left1:
-                if len(c) > reeb_component_thd:
-                    self.filtered_nodes += c
-                else:
-                    for node in c:
-                        if node in self.final_components_filtered:
-                            components_removed.append(c)
-                            break
-        nodes = []
-        self.filtered_nodes = np.intersect1d(self.filtered_nodes,list(self.final_components_filtered.keys()))
-        for i in self.filtered_nodes:
-            component = np.array(self.final_components_filtered[i])
-            nodes += component.tolist()
-        nodes = list(set(nodes))
-        if verbose:
-            print("Number of samples included after merging reeb components:", len(set(nodes)))
+    # nodes of reeb components larger than reeb_component_thd, and the smaller reeb
+    # components that contain at least one filtered reeb node
+    def _split_reeb_components(self,labels,reeb_component_thd):
+        sizes = np.bincount(labels)
+        members = np.argsort(labels,kind="stable")
+        indptr = np.r_[0,np.cumsum(sizes)]
+        is_filtered = np.zeros(len(labels),dtype=bool)
+        is_filtered[list(self.final_components_filtered.keys())] = True
+        has_filtered = np.bincount(labels,weights=is_filtered,minlength=len(sizes)) > 0
+        filtered_nodes = members[np.repeat(sizes > reeb_component_thd,sizes)]
+        components_removed = [
+            members[indptr[i]:indptr[i+1]].tolist() for i in np.nonzero((sizes <= reeb_component_thd)*has_filtered)[0]]
+        return filtered_nodes,components_removed
+
+    def build_reeb_graph(
+        self,M,Ar,reeb_component_thd=10,max_iters=10,is_merging=True,edges_dists=None,verbose=False,max_bytes=None):
+        with self.profiler.stage("build_reeb_graph") as stage:
+            extra_edges = [[],[]]
+            print("Build reeb graph...")
+            reeb_dim = np.max(list(self.final_components_filtered.keys()))+1
+            keys = list(self.final_components_filtered.keys())
+            indptr,members = self.final_components_filtered.gather(keys)
+            bipartite_g = sp.csr_matrix(
+                (np.ones(len(members),dtype=self.dtype),(np.repeat(keys,np.diff(indptr)),members)),shape=(reeb_dim,M.shape[0]))
+            A_tmp = overlap_adjacency(bipartite_g,max_bytes=max_bytes,dtype=self.dtype)
+            reeb_components = UnionFind(reeb_dim,labels=sp.csgraph.connected_components(A_tmp,directed=False)[1])
+            bridges = [[],[]]
+            self.filtered_nodes,components_removed = self._split_reeb_components(
+                reeb_components.labels(),reeb_component_thd)
+            curr_iter = 0
+            modified = True
+            with self.profiler.stage("reconnect",components_removed=len(components_removed)) as reconnect_stage:
+                while modified and is_merging and len(components_removed) > 0 and curr_iter < max_iters:
+                    modified = False
+                    curr_iter += 1
+                    if not isinstance(edges_dists,NeighborIndex):
+                        edges_dists = NeighborIndex(edges_dists)
+                    key_indptr,members = self.final_components_filtered.gather(list(itertools.chain(*components_removed)))
+                    group_indptr = key_indptr[np.r_[0,np.cumsum([len(c) for c in components_removed])]]
+                    closest,sources = edges_dists.nearest_outside(members,group_indptr)
+                    candidates = []
+                    for component_removed,closest_neigh,node_to_connect in tqdm(
+                            zip(components_removed,closest.tolist(),sources.tolist()),disable=1-verbose):
+                        if closest_neigh != -1:
+                            key_to_connect = np.min(list(self.node_assignments[node_to_connect].intersection(component_removed)))
+                            candidates.append((key_to_connect,node_to_connect,closest_neigh))
+                    closest_neighs = np.array([closest_neigh for _,_,closest_neigh in candidates],dtype=np.int64)
+                    components_to_connect = self._smallest_components_containing(closest_neighs,include_tiny=False)
+                    for (key_to_connect,node_to_connect,closest_neigh),component_to_connect in zip(
+                            candidates,components_to_connect.tolist()):
+                        if component_to_connect != -1:
+                            bridges[0].append(key_to_connect)
+                            bridges[1].append(component_to_connect)
+                            extra_edges[0].append(node_to_connect)
+                            extra_edges[1].append(closest_neigh)
+                            reeb_components.union(key_to_connect,component_to_connect)
+                            modified = True
+                    self.filtered_nodes,components_removed = self._split_reeb_components(
+                        reeb_components.labels(),reeb_component_thd)
+                reconnect_stage["info"].update(iterations=curr_iter,bridges=len(bridges[0]))
+            if len(bridges[0]) > 0:
+                A_tmp = A_tmp+sp.csr_matrix(
+                    (np.ones(len(bridges[0]),dtype=self.dtype),(bridges[0],bridges[1])),shape=(reeb_dim,reeb_dim))
+                A_tmp = ((A_tmp+A_tmp.T)>0).astype(self.dtype)
+            nodes = []
+            self.filtered_nodes = np.intersect1d(self.filtered_nodes,list(self.final_components_filtered.keys()))
+            for i in self.filtered_nodes:
+                component = self.final_components_filtered.members(i)
+                nodes += component.tolist()
+            nodes = list(set(nodes))
+            if verbose:
+                print("Number of samples included after merging reeb components:", len(set(nodes)))
+            stage["info"].update(reeb_nodes=int(reeb_dim),filtered_nodes=len(self.filtered_nodes))
         return A_tmp,extra_edges
\ No newline at end of file
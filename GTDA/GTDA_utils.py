@@ -1,9 +1,10 @@
 from requests import session
 import scipy.sparse as sp
+import scipy.sparse.linalg
 import numpy as np
 import torch.nn.functional as F
 import numpy as np
-from collections import Counter
+from collections import Counter, defaultdict, OrderedDict
 import torch
 from torch_geometric.data import InMemoryDataset
 from torch_geometric.data import Data
@@ -23,7 +24,18 @@ import time
 # from rembg import remove
 # from rembg.session_factory import new_session
 import json
+import io
+import contextlib
 from collections import defaultdict
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+from joblib import Parallel, delayed
+from contextlib import contextmanager
+import sys
+try:
+    import resource
+except ImportError:
+    resource = None
 
 def extend_coords(origin, point, scale):
     ox, oy = origin
@@ -88,18 +100,561 @@ def random_splits(data, num_classes, train_percent=0.1, val_percent=0.1, seed=0)
 def find_components(A,size_thd=100,verbose=False):
     if A.nnz == 0 and size_thd == 0:
         return list(range(A.shape[0])), [[i] for i in range(A.shape[0])]
-    ret = sp.csgraph.connected_components(A,directed=False)
+    labels,indptr,members = find_components_array(A,size_thd=size_thd)
     if verbose:
-        print(f"component sizes: {Counter(ret[1])}")
-    components = [[] for i in range(ret[0])]
-    for i,l in enumerate(ret[1]):
-        components[l].append(i)
-    selected_components = [list(c) for c in components if len(c)>size_thd]
-    selected_nodes = []
-    for c in selected_components:
-        selected_nodes += c
+        print(f"component sizes: {Counter(labels)}")
+    selected_components = [members[indptr[i]:indptr[i+1]].tolist() for i in range(len(indptr)-1)]
+    selected_nodes = members.tolist()
     return selected_nodes, selected_components
 
+"""
+Array version of find_components. Returns the component label of every node together
+with the components larger than size_thd grouped CSR-style, i.e. the k-th selected
+component is members[indptr[k]:indptr[k+1]] in increasing order. Selected components
+are ordered by label, which is the order find_components returns them in.
+"""
+def find_components_array(A,size_thd=100):
+    _,labels = sp.csgraph.connected_components(A,directed=False)
+    sizes = np.bincount(labels)
+    selected = sizes > size_thd
+    order = np.argsort(labels,kind="stable")
+    members = order[selected[labels[order]]]
+    indptr = np.zeros(np.sum(selected)+1,dtype=np.int64)
+    np.cumsum(sizes[selected],out=indptr[1:])
+    return labels,indptr,members
+
+"""
+Induced subgraphs of A on groups of nodes laid out contiguously, group k being
+members[indptr[k]:indptr[k+1]]. A node can appear in several groups. Row p of the
+result holds the neighbors of members[p] that belong to the same group, with column
+indices local to that group, so each subgraph is a slice of the returned arrays
+(see group_subgraph) instead of a fancy-indexed copy of A.
+"""
+def group_subgraphs(A,members,indptr):
+    A = A.tocsr()
+    n = A.shape[0]
+    members = np.asarray(members,dtype=np.int64)
+    indptr = np.asarray(indptr,dtype=np.int64)
+    sizes = np.diff(indptr)
+    group_of = np.repeat(np.arange(len(sizes),dtype=np.int64),sizes)
+    local = np.arange(len(members),dtype=np.int64)-np.repeat(indptr[:-1],sizes)
+    starts = A.indptr[members].astype(np.int64)
+    degs = A.indptr[members+1]-starts
+    rows = np.repeat(np.arange(len(members),dtype=np.int64),degs)
+    edge_ids = np.arange(len(rows),dtype=np.int64)+np.repeat(starts-(np.cumsum(degs)-degs),degs)
+    # an edge is kept when (group of its row, neighbor) is also a (group, member) pair
+    keys = group_of*n+members
+    key_order = np.argsort(keys,kind="stable")
+    sorted_keys = keys[key_order]
+    query = group_of[rows]*n+A.indices[edge_ids]
+    loc = np.minimum(np.searchsorted(sorted_keys,query),max(len(sorted_keys)-1,0))
+    hit = np.nonzero(sorted_keys[loc] == query)[0] if len(sorted_keys) > 0 else np.zeros(0,dtype=np.int64)
+    index_dtype = np.int32 if max(len(members),len(hit)) < np.iinfo(np.int32).max else np.int64
+    sub_indices = local[key_order[loc[hit]]].astype(index_dtype)
+    sub_data = A.data[edge_ids[hit]]
+    sub_indptr = np.zeros(len(members)+1,dtype=index_dtype)
+    np.cumsum(np.bincount(rows[hit],minlength=len(members)),out=sub_indptr[1:])
+    return sub_indptr,sub_indices,sub_data
+
+def group_subgraph(subgraphs,indptr,k):
+    sub_indptr,sub_indices,sub_data = subgraphs
+    start,end = indptr[k],indptr[k+1]
+    ptr = sub_indptr[start:(end+1)]
+    G = sp.csr_matrix((end-start,end-start),dtype=sub_data.dtype)
+    # assigned directly since the constructor copies slices much smaller than their base array
+    G.indptr = ptr-ptr[0]
+    G.indices = sub_indices[ptr[0]:ptr[-1]]
+    G.data = sub_data[ptr[0]:ptr[-1]]
+    return G
+
+# all group subgraphs as one block-diagonal matrix over the concatenated layout
+def block_diagonal(subgraphs,indptr):
+    sub_indptr,sub_indices,sub_data = subgraphs
+    group_offsets = np.repeat(indptr[:-1],np.diff(indptr))
+    indices = sub_indices+np.repeat(group_offsets,np.diff(sub_indptr)).astype(sub_indices.dtype)
+    return sp.csr_matrix((sub_data,indices,sub_indptr),shape=(indptr[-1],indptr[-1]))
+
+"""
+Neighbors of every node sorted by distance (then by index), built once from the symmetric edges_dists
+so that nearest neighbor queries only walk the front of each row instead of slicing the matrix.
+"""
+class NeighborIndex(object):
+    def __init__(self,D):
+        D = D.tocsr()
+        rows = np.repeat(np.arange(D.shape[0],dtype=np.int64),np.diff(D.indptr))
+        order = np.lexsort((D.indices,D.data,rows))
+        self.shape = D.shape
+        self.indptr = D.indptr.astype(np.int64)
+        self.indices = D.indices[order]
+        self.dists = D.data[order]
+
+    # For every group of nodes members[indptr[k]:indptr[k+1]] the closest neighbor outside the group and
+    # the member it is reached from, -1 for groups without outside edges. Each member row is walked
+    # until its first neighbor outside the group; ties go to the earlier member in the group and then
+    # to the smaller neighbor index, the order np.argmin sees when scanning D[group,:].
+    def nearest_outside(self,members,indptr):
+        n = self.shape[1]
+        members = np.asarray(members,dtype=np.int64)
+        indptr = np.asarray(indptr,dtype=np.int64)
+        sizes = np.diff(indptr)
+        group_of = np.repeat(np.arange(len(sizes),dtype=np.int64),sizes)
+        sorted_keys = np.sort(group_of*n+members)
+        pos = self.indptr[members]
+        end = self.indptr[members+1]
+        found = np.full(len(members),-1,dtype=np.int64)
+        active = np.nonzero(pos < end)[0]
+        while len(active) > 0:
+            cols = self.indices[pos[active]].astype(np.int64)
+            query = group_of[active]*n+cols
+            loc = np.minimum(np.searchsorted(sorted_keys,query),len(sorted_keys)-1)
+            internal = sorted_keys[loc] == query
+            found[active[~internal]] = cols[~internal]
+            active = active[internal]
+            pos[active] += 1
+            active = active[pos[active] < end[active]]
+        rows = np.nonzero(found != -1)[0]
+        order = rows[np.lexsort((rows,self.dists[pos[rows]],group_of[rows]))]
+        first = order[np.r_[True,group_of[order][1:] != group_of[order][:-1]]] if len(order) > 0 else order
+        closest = np.full(len(sizes),-1,dtype=np.int64)
+        sources = np.full(len(sizes),-1,dtype=np.int64)
+        closest[group_of[first]] = found[first]
+        sources[group_of[first]] = members[first]
+        return closest,sources
+
+"""
+Adjacency of the rows of a row-by-sample incidence matrix B that share at least one
+sample, i.e. the off-diagonal pattern of B@B.T. With max_bytes set the product is
+computed in blocks of rows whose worst-case output fits the budget.
+"""
+def overlap_adjacency(B,max_bytes=None,dtype=np.float64):
+    B = B.tocsr().astype(dtype)
+    B.data[:] = 1
+    Bt = B.T.tocsr()
+    n = B.shape[0]
+    if max_bytes is None:
+        bounds = [0,n]
+    else:
+        # entries of a product row are bounded by the number of (sample, row) pairs it reaches
+        row_work = B@np.diff(Bt.indptr).astype(np.float64)
+        cumulative_bytes = np.r_[0,np.cumsum(row_work)*(B.data.itemsize+B.indices.itemsize)]
+        bounds = [0]
+        while bounds[-1] < n:
+            end = np.searchsorted(cumulative_bytes,cumulative_bytes[bounds[-1]]+max_bytes,side="right")-1
+            bounds.append(int(min(max(end,bounds[-1]+1),n)))
+    ei,ej = [],[]
+    for start,end in zip(bounds[:-1],bounds[1:]):
+        block = (B[start:end]@Bt).tocoo()
+        off_diagonal = block.row+start != block.col
+        ei.append(block.row[off_diagonal]+start)
+        ej.append(block.col[off_diagonal])
+    ei = np.concatenate(ei) if len(ei) > 0 else np.zeros(0,dtype=np.int64)
+    ej = np.concatenate(ej) if len(ej) > 0 else np.zeros(0,dtype=np.int64)
+    A = sp.csr_matrix((np.ones(len(ei),dtype=dtype),(ei,ej)),shape=(n,n))
+    A.sum_duplicates()
+    return A
+
+# smallest of int32/int64 that can index n entries, or index_dtype if given and large enough
+def get_index_dtype(n,index_dtype=None):
+    if index_dtype is None:
+        return np.int32 if n <= np.iinfo(np.int32).max else np.int64
+    if n > np.iinfo(index_dtype).max:
+        raise ValueError("{} entries cannot be indexed with {}".format(n,np.dtype(index_dtype)))
+    return np.dtype(index_dtype).type
+
+"""
+Order-independent 64-bit fingerprint of every CSR segment: members are mixed with splitmix64 and summed
+with uint64 wraparound, so two segments holding the same set of members always hash to the same value.
+"""
+def segment_hashes(indptr,members):
+    x = members.astype(np.uint64)+np.uint64(0x9E3779B97F4A7C15)
+    x = (x^(x>>np.uint64(30)))*np.uint64(0xBF58476D1CE4E5B9)
+    x = (x^(x>>np.uint64(27)))*np.uint64(0x94D049BB133111EB)
+    x = x^(x>>np.uint64(31))
+    cumulative = np.zeros(len(x)+1,dtype=np.uint64)
+    np.cumsum(x,out=cumulative[1:])
+    return cumulative[indptr[1:]]-cumulative[indptr[:-1]]
+
+"""
+Order of CSR segments comparing their members like python lists, element by element and with a segment
+that is a prefix of another one first. Ties are refined one position at a time, only among the segments
+that still share a prefix, so the work is bounded by the length of common prefixes.
+"""
+def lexicographic_order(indptr,members):
+    sizes = np.diff(indptr)
+    order = np.arange(len(sizes),dtype=np.int64)
+    # run of tied segments every position of order belongs to, identified by its first position
+    runs = np.zeros(len(sizes),dtype=np.int64)
+    active = order.copy() if len(sizes) > 1 else np.zeros(0,dtype=np.int64)
+    position = 0
+    while len(active) > 0:
+        segments = order[active]
+        has_value = sizes[segments] > position
+        vals = np.full(len(segments),-1,dtype=np.int64)
+        vals[has_value] = members[indptr[segments[has_value]]+position]
+        # runs are contiguous and increasing along active, sorting by run keeps them in place
+        sub = np.lexsort((vals,runs[active]))
+        order[active] = segments[sub]
+        vals = vals[sub]
+        run_ids = runs[active]
+        starts = np.r_[True,(run_ids[1:] != run_ids[:-1]) | (vals[1:] != vals[:-1])]
+        runs[active] = np.maximum.accumulate(np.where(starts,active,0))
+        run_sizes = np.bincount(np.cumsum(starts)-1)
+        # segments that ended together are equal and need no further refinement
+        active = active[(run_sizes[np.cumsum(starts)-1] > 1) & (vals != -1)]
+        position += 1
+    return order
+
+"""
+Compact replacement for the dict-of-lists component records. Members of all components
+are kept in one growing integer buffer and every key maps to its (start, end) range in
+it, instead of a Python list of ints per component. Dict-style access still returns
+lists for backward compatibility, members() returns a read-only view into the buffer.
+Replaced or deleted components leave garbage behind that is compacted once it
+outweighs live data.
+"""
+class ComponentStore(object):
+    def __init__(self,components=None,dtype=np.int32):
+        self.dtype = np.dtype(dtype)
+        self._buffer = np.zeros(1024,dtype=self.dtype)
+        self._size = 0
+        self._garbage = 0
+        self._ranges = {}
+        if components is not None:
+            for key,members in components.items():
+                self[key] = members
+
+    def _reserve(self,extra):
+        if self._size+extra > len(self._buffer):
+            buffer = np.zeros(max(2*len(self._buffer),self._size+extra),dtype=self.dtype)
+            buffer[:self._size] = self._buffer[:self._size]
+            self._buffer = buffer
+
+    def _release(self,start,end):
+        self._garbage += end-start
+        if self._garbage > 1024 and self._garbage > self._size//2:
+            self.compact()
+
+    def compact(self):
+        keys = list(self._ranges.keys())
+        indptr,members = self.gather(keys)
+        self._buffer = np.zeros(max(len(members),1024),dtype=self.dtype)
+        self._buffer[:len(members)] = members
+        self._size = len(members)
+        self._garbage = 0
+        self._ranges = {key:(int(indptr[i]),int(indptr[i+1])) for i,key in enumerate(keys)}
+
+    # members are kept in the given order, and like in a dict a replaced key keeps its position
+    def __setitem__(self,key,members):
+        members = np.asarray(members,dtype=self.dtype).reshape(-1)
+        replaced = self._ranges.get(key)
+        self._reserve(len(members))
+        self._buffer[self._size:(self._size+len(members))] = members
+        self._ranges[key] = (self._size,self._size+len(members))
+        self._size += len(members)
+        if replaced is not None:
+            self._release(*replaced)
+
+    def __getitem__(self,key):
+        return self.members(key).tolist()
+
+    def members(self,key):
+        start,end = self._ranges[key]
+        members = self._buffer[start:end]
+        members.flags.writeable = False
+        return members
+
+    def size(self,key):
+        start,end = self._ranges[key]
+        return end-start
+
+    def __delitem__(self,key):
+        self._release(*self._ranges.pop(key))
+
+    def __contains__(self,key):
+        return key in self._ranges
+
+    def __len__(self):
+        return len(self._ranges)
+
+    def __iter__(self):
+        return iter(self._ranges)
+
+    def keys(self):
+        return self._ranges.keys()
+
+    def values(self):
+        return (self[key] for key in self._ranges)
+
+    def items(self):
+        return ((key,self[key]) for key in self._ranges)
+
+    def get(self,key,default=None):
+        return self[key] if key in self._ranges else default
+
+    def sizes(self,keys=None):
+        keys = self._ranges.keys() if keys is None else keys
+        return np.array([self.size(key) for key in keys],dtype=np.int64)
+
+    # concatenated members of keys in one vectorized gather, CSR-style as (indptr, members)
+    def gather(self,keys=None):
+        keys = list(self._ranges.keys()) if keys is None else keys
+        ranges = np.array([self._ranges[key] for key in keys],dtype=np.int64).reshape(-1,2)
+        sizes = ranges[:,1]-ranges[:,0]
+        indptr = np.zeros(len(keys)+1,dtype=np.int64)
+        np.cumsum(sizes,out=indptr[1:])
+        positions = np.arange(indptr[-1],dtype=np.int64)+np.repeat(ranges[:,0]-indptr[:-1],sizes)
+        return indptr,self._buffer[positions]
+
+    # store holding members[indptr[i]:indptr[i+1]] under keys[i]
+    @classmethod
+    def from_csr(cls,keys,indptr,members,dtype=np.int32):
+        store = cls(dtype=dtype)
+        store._reserve(len(members))
+        store._buffer[:len(members)] = members
+        store._size = len(members)
+        store._ranges = {key:(int(indptr[i]),int(indptr[i+1])) for i,key in enumerate(keys)}
+        return store
+
+    def subset(self,keys):
+        indptr,members = self.gather(keys)
+        return ComponentStore.from_csr(keys,indptr,members,dtype=self.dtype)
+
+    # distinct components (members sorted) renumbered 0..k-1 in lexicographic order of their members,
+    # the order sorted() puts lists in; duplicates are found by (size, 64-bit hash) and confirmed
+    # exactly only on fingerprint collisions
+    def unique(self):
+        keys = list(self._ranges.keys())
+        indptr,members = self.gather(keys)
+        sizes = np.diff(indptr)
+        segment = np.repeat(np.arange(len(keys)),sizes)
+        members = members[np.lexsort((members,segment))]
+        hashes = segment_hashes(indptr,members)
+        order = np.lexsort((np.arange(len(keys)),hashes,sizes))
+        run_start = np.ones(len(keys),dtype=bool)
+        run_start[1:] = (sizes[order][1:] != sizes[order][:-1]) | (hashes[order][1:] != hashes[order][:-1])
+        reps = np.empty(len(keys),dtype=np.int64)
+        reps[order] = order[np.flatnonzero(run_start)[np.cumsum(run_start)-1]]
+        dup = np.flatnonzero(reps != np.arange(len(keys)))
+        if len(dup) > 0:
+            dup_sizes = sizes[dup]
+            offsets = np.arange(dup_sizes.sum())-np.repeat(np.cumsum(dup_sizes)-dup_sizes,dup_sizes)
+            differ = members[np.repeat(indptr[dup],dup_sizes)+offsets] != \
+                members[np.repeat(indptr[reps[dup]],dup_sizes)+offsets]
+            collided = dup[np.bincount(np.repeat(np.arange(len(dup)),dup_sizes),weights=differ,minlength=len(dup)) > 0]
+            if len(collided) > 0:
+                classes = defaultdict(list)
+                for i in np.flatnonzero(reps == np.arange(len(keys))):
+                    classes[reps[i]].append(i)
+                for i in collided:
+                    candidates = classes[reps[i]]
+                    for j in candidates:
+                        if np.array_equal(members[indptr[i]:indptr[i+1]],members[indptr[j]:indptr[j+1]]):
+                            reps[i] = j
+                            break
+                    else:
+                        candidates.append(i)
+                        reps[i] = i
+        kept = np.flatnonzero(reps == np.arange(len(keys)))
+        kept_indptr = np.zeros(len(kept)+1,dtype=np.int64)
+        np.cumsum(sizes[kept],out=kept_indptr[1:])
+        positions = np.arange(kept_indptr[-1],dtype=np.int64)+np.repeat(indptr[kept]-kept_indptr[:-1],sizes[kept])
+        kept = kept[lexicographic_order(kept_indptr,members[positions])]
+        store = ComponentStore(dtype=self.dtype)
+        store._reserve(int(sizes[kept].sum()))
+        for i,c in enumerate(kept):
+            store[i] = members[indptr[c]:indptr[c+1]]
+        return store
+
+def peak_rss():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on linux, bytes on macOS
+    return int(peak) if sys.platform == "darwin" else int(peak)*1024
+
+# current resident set size in bytes from /proc/self/statm, None where it is not available
+def current_rss():
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1])*os.sysconf("SC_PAGE_SIZE")
+    except (OSError,ValueError,IndexError):
+        return None
+
+"""
+Wall time, CPU time and RSS of named pipeline stages, plus counters. Stages are used as
+`with profiler.stage(name) as record:`, or opened with start() and closed with stop(), and can be nested.
+Extra keyword arguments and record["info"] are kept as stage info. hook, if given, is called as
+hook(event, record) with event "start" or "stop" at every stage boundary. CPU time covers all threads of
+this process but not worker processes. rss is the resident set size when the stage ends and rss_delta its
+change over the stage, both None where /proc/self/statm is missing; process_peak_rss is the high-water
+mark of the whole process when the stage ends, which earlier stages may have set.
+"""
+class StageProfiler(object):
+    def __init__(self,hook=None):
+        self.hook = hook
+        self.stages = []
+        self.counters = defaultdict(int)
+        self._open = []
+        self._t0 = time.perf_counter()
+
+    def start(self,name,**info):
+        record = {"name":name,"depth":len(self._open),"start":time.perf_counter()-self._t0,"info":dict(info)}
+        record["_wall"],record["_cpu"],record["_rss"] = time.perf_counter(),time.process_time(),current_rss()
+        self._open.append(record)
+        if self.hook is not None:
+            self.hook("start",record)
+        return record
+
+    def stop(self,record,**info):
+        record["wall_time"] = time.perf_counter()-record.pop("_wall")
+        record["cpu_time"] = time.process_time()-record.pop("_cpu")
+        rss,start_rss = current_rss(),record.pop("_rss")
+        record["rss"] = rss
+        record["rss_delta"] = None if rss is None or start_rss is None else rss-start_rss
+        record["process_peak_rss"] = peak_rss()
+        record["info"].update(info)
+        self._open.remove(record)
+        self.stages.append(record)
+        if self.hook is not None:
+            self.hook("stop",record)
+        return record
+
+    @contextmanager
+    def stage(self,name,**info):
+        record = self.start(name,**info)
+        try:
+            yield record
+        finally:
+            self.stop(record)
+
+    def count(self,name,value=1):
+        self.counters[name] += value
+
+    # hooks are often closures, so they are not pickled with the profiler
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["hook"] = None
+        return state
+
+    def to_dict(self):
+        return {
+            "stages":sorted([dict(record) for record in self.stages],key=lambda record: record["start"]),
+            "counters":dict(self.counters)}
+
+    def to_json(self,path=None,**kwargs):
+        text = json.dumps(
+            self.to_dict(),default=lambda x: x.item() if hasattr(x,"item") else str(x),**kwargs)
+        if path is not None:
+            with open(path,"w") as f:
+                f.write(text)
+        return text
+
+# which reeb nodes every sample belongs to, kept as sorted int64 keys sample*nnodes+node
+# instead of one python set per sample; updates are applied in bulk.
+class NodeAssignments(object):
+    def __init__(self,nsamples,nnodes):
+        self.nsamples = nsamples
+        self.nnodes = nnodes
+        self._keys = np.zeros(0,dtype=np.int64)
+
+    @classmethod
+    def from_components(cls,store,keys,nsamples,nnodes):
+        assignments = cls(nsamples,nnodes)
+        indptr,members = store.gather(keys)
+        assignments.add(members,np.repeat(np.asarray(keys,dtype=np.int64),np.diff(indptr)))
+        return assignments
+
+    def _encode(self,samples,nodes):
+        samples = np.asarray(samples,dtype=np.int64).reshape(-1)
+        nodes = np.broadcast_to(np.asarray(nodes,dtype=np.int64),samples.shape)
+        return samples*self.nnodes+nodes
+
+    # adds (added[i] True) and removes (False) of nodes[i] to samples[i], applied in order
+    def update(self,samples,nodes,added):
+        keys = self._encode(samples,nodes)
+        added = np.broadcast_to(np.asarray(added,dtype=bool),keys.shape)
+        # the last update of a key decides whether it is kept
+        _,last = np.unique(keys[::-1],return_index=True)
+        last = len(keys)-1-last
+        kept = self._keys[~np.isin(self._keys,keys[last[~added[last]]])]
+        self._keys = np.union1d(kept,keys[last[added[last]]])
+
+    def add(self,samples,nodes):
+        self.update(samples,nodes,True)
+
+    def remove(self,samples,nodes):
+        self.update(samples,nodes,False)
+
+    # reeb nodes of each sample in ascending order, CSR-style as (indptr, nodes)
+    def nodes_of(self,samples):
+        samples = np.asarray(samples,dtype=np.int64).reshape(-1)
+        starts = np.searchsorted(self._keys,samples*self.nnodes)
+        ends = np.searchsorted(self._keys,(samples+1)*self.nnodes)
+        sizes = ends-starts
+        indptr = np.zeros(len(samples)+1,dtype=np.int64)
+        np.cumsum(sizes,out=indptr[1:])
+        positions = np.arange(indptr[-1],dtype=np.int64)+np.repeat(starts-indptr[:-1],sizes)
+        return indptr,self._keys[positions]%self.nnodes
+
+    # whether samples x[i] and y[i] belong to at least one common reeb node
+    def share_node(self,x,y):
+        x = np.asarray(x,dtype=np.int64).reshape(-1)
+        y = np.asarray(y,dtype=np.int64).reshape(-1)
+        indptr,nodes = self.nodes_of(x)
+        pairs = np.repeat(np.arange(len(x)),np.diff(indptr))
+        query = y[pairs]*self.nnodes+nodes
+        loc = np.minimum(np.searchsorted(self._keys,query),max(len(self._keys)-1,0))
+        hit = self._keys[loc] == query if len(self._keys) > 0 else np.zeros(len(query),dtype=bool)
+        return np.bincount(pairs,weights=hit,minlength=len(x)) > 0
+
+    def __getitem__(self,sample):
+        return set(self.nodes_of([sample])[1].tolist())
+
+    def __len__(self):
+        return self.nsamples
+
+# disjoint sets over n items with union by size and path halving, optionally starting
+# from an existing partition given as component labels
+class UnionFind(object):
+    def __init__(self,n,labels=None):
+        if labels is None:
+            self.parent = np.arange(n,dtype=np.int64)
+        else:
+            _,first = np.unique(labels,return_index=True)
+            self.parent = first[labels].astype(np.int64)
+        self.sizes = np.bincount(self.parent,minlength=n).astype(np.int64)
+
+    def find(self,x):
+        parent = self.parent
+        while parent[x] != x:
+            parent[x] = parent[parent[x]]
+            x = parent[x]
+        return x
+
+    def union(self,x,y):
+        x,y = self.find(x),self.find(y)
+        if x == y:
+            return False
+        if self.sizes[x] < self.sizes[y]:
+            x,y = y,x
+        self.parent[y] = x
+        self.sizes[x] += self.sizes[y]
+        return True
+
+    # set label of every item, sets numbered in order of their smallest member like
+    # scipy's connected_components
+    def labels(self):
+        roots = self.parent
+        while True:
+            next_roots = roots[roots]
+            if np.array_equal(next_roots,roots):
+                break
+            roots = next_roots
+        _,first,inverse = np.unique(roots,return_index=True,return_inverse=True)
+        rank = np.empty(len(first),dtype=np.int64)
+        rank[np.argsort(first)] = np.arange(len(first))
+        return rank[inverse.reshape(-1)]
+
 def find_largest_component(A):
     components = find_components(A,size_thd=0)[1]
     largest_component_id = np.argmax([len(c) for c in components])
@@ -114,6 +669,31 @@ class NN_model(object):
         self.val_mask = None
         self.test_mask = None
 
+"""
+Load a dataset saved under dataset/precomputed as an NN_model, the format is the one used by the
+analyze_*.ipynb notebooks: edge_list.txt starts with a "num_nodes num_nodes num_edges" line, masks are
+read from {train,val,test}_nodes.txt when present. Returns the model and extra_lens, which is None if
+the dataset has no extra_lens.npy.
+"""
+def load_precomputed(name,root="dataset/precomputed"):
+    savepath = osp.join(root,name)
+    with open(f"{savepath}/edge_list.txt","r") as f:
+        num_nodes = int(f.readline().strip().split(' ')[0])
+    edges = np.loadtxt(f"{savepath}/edge_list.txt",dtype=np.int64,skiprows=1,ndmin=2)
+    nn_model = NN_model()
+    nn_model.A = sp.csr_matrix((edges[:,2],(edges[:,0],edges[:,1])),(num_nodes,num_nodes))
+    nn_model.preds = np.load(f"{savepath}/prediction_lens.npy")
+    nn_model.labels = np.load(f"{savepath}/labels.npy")
+    for split in ["train","val","test"]:
+        mask = np.zeros(num_nodes)
+        if osp.isfile(f"{savepath}/{split}_nodes.txt") and osp.getsize(f"{savepath}/{split}_nodes.txt") > 0:
+            mask[np.loadtxt(f"{savepath}/{split}_nodes.txt",dtype=np.int64,ndmin=1)] = 1
+        setattr(nn_model,f"{split}_mask",mask)
+    extra_lens = None
+    if osp.isfile(f"{savepath}/extra_lens.npy"):
+        extra_lens = np.load(f"{savepath}/extra_lens.npy")
+    return nn_model,extra_lens
+
 # convert any graph with feature matrix to InMemoryDataset
 class data_generator(InMemoryDataset):
     def __init__(self,G,X,labels,name,root_path="dataset/",
@@ -286,6 +866,598 @@ def knn_cuda_graph(X,knn,batch_size,thd=0,device=None,batch_training=False,batch
         check_free_memory()
     return A_knn
     
+"""
+Sparse top-k lens of a prediction matrix, only the k largest entries of every row are kept (with sorted
+column indices) and the rest become implicit zeros. GTDA takes such a csr lens in place of a dense one,
+which is what makes lenses with many classes fit in memory. Rows can be converted in batches and stacked
+with sp.vstack. preds can also be sparse, ties then go to the smaller column.
+"""
+def topk_lens(preds,k,dtype=None):
+    k = max(min(k,preds.shape[1]),1)
+    if sp.issparse(preds):
+        P = preds.tocsr()
+        P.sort_indices()
+        rows = np.repeat(np.arange(P.shape[0],dtype=np.int64),np.diff(P.indptr))
+        order = np.lexsort((-P.data,rows))
+        keep = np.sort(order[(np.arange(len(order))-P.indptr[rows[order]]) < k])
+        return sp.csr_matrix(
+            (P.data[keep].astype(dtype or P.dtype),(rows[keep],P.indices[keep])),shape=P.shape)
+    preds = np.asarray(preds) if dtype is None else np.asarray(preds,dtype=dtype)
+    cols = np.sort(np.argpartition(-preds,k-1,axis=1)[:,:k],1)
+    vals = np.take_along_axis(preds,cols,1)
+    indptr = np.arange(0,preds.shape[0]*k+1,k,dtype=get_index_dtype(preds.shape[0]*k))
+    return sp.csr_matrix((vals.reshape(-1),cols.reshape(-1).astype(indptr.dtype),indptr),shape=preds.shape)
+
+# csr matrix X with only the k largest entries of every row kept among its first ncols columns
+def _topk_columns(X,k,ncols):
+    X = X.tocsr()
+    if ncols >= X.shape[1]:
+        return topk_lens(X,k)
+    return sp.hstack([topk_lens(X[:,:ncols],k),X[:,ncols:]],format="csr")
+
+# Column statistics of a dense or sparse (csr) lens. Implicit zeros of a sparse lens are values like any
+# other, they count in the minimum and maximum, the standard deviation and the columns returned.
+def lens_min_max(M):
+    if sp.issparse(M):
+        # reduce the stored entries of each column in place of scipy's min(0)/max(0), which go through csc
+        M = M.tocsr()
+        # the accumulators share the dtype of M.data, ufunc.at falls back to a slow loop otherwise
+        lo,hi = np.full(M.shape[1],np.inf,dtype=M.dtype),np.full(M.shape[1],-np.inf,dtype=M.dtype)
+        np.minimum.at(lo,M.indices,M.data)
+        np.maximum.at(hi,M.indices,M.data)
+        implicit = np.bincount(M.indices,minlength=M.shape[1]) < M.shape[0]
+        lo[implicit],hi[implicit] = np.minimum(lo[implicit],0),np.maximum(hi[implicit],0)
+        return lo,hi
+    return np.min(M,0),np.max(M,0)
+
+def lens_std(M):
+    if sp.issparse(M):
+        mean = np.asarray(M.mean(0)).reshape(-1)
+        squares = np.asarray(M.multiply(M).mean(0)).reshape(-1)
+        return np.sqrt(np.maximum(squares-mean**2,0))
+    return np.std(M,0)
+
+# stored entries of a sparse lens grouped by segment and column: the distinct keys segment*ncols+column in
+# increasing order, the start of every group in the entries sorted by key, and the sorted entries
+def _segment_entries(M,indptr):
+    sizes = np.diff(indptr)
+    segment = np.repeat(np.arange(len(sizes),dtype=np.int64),sizes)
+    keys = segment[np.repeat(np.arange(M.shape[0]),np.diff(M.indptr))]*M.shape[1]+M.indices
+    order = np.argsort(keys,kind="stable")
+    keys = keys[order]
+    starts = np.nonzero(np.r_[True,keys[1:] != keys[:-1]])[0] if len(keys) > 0 else np.zeros(0,dtype=np.int64)
+    return keys[starts],starts,M.data[order]
+
+def _segment_matrix(keys,values,shape):
+    return sp.csr_matrix((values,(keys//shape[1],keys%shape[1])),shape=shape)
+
+# Column ranges and standard deviations of the row segments indptr[i]:indptr[i+1] of a lens, one row per
+# segment. Ranges are computed for all segments at once, standard deviations of a dense lens are those of
+# np.std on every segment. Segments must not be empty. For a sparse lens they are sparse
+# too: only the (segment, column) pairs holding stored entries are reduced, the others are 0.
+def segment_min_max(M,indptr):
+    if sp.issparse(M):
+        M = M.tocsr()
+        sizes = np.diff(indptr)
+        shape = (len(sizes),M.shape[1])
+        keys,starts,data = _segment_entries(M,indptr)
+        if len(keys) == 0:
+            return sp.csr_matrix(shape,dtype=M.dtype),sp.csr_matrix(shape,dtype=M.dtype)
+        lo,hi = np.minimum.reduceat(data,starts),np.maximum.reduceat(data,starts)
+        implicit = np.diff(np.r_[starts,len(data)]) < sizes[keys//shape[1]]
+        lo[implicit],hi[implicit] = np.minimum(lo[implicit],0),np.maximum(hi[implicit],0)
+        return _segment_matrix(keys,lo,shape),_segment_matrix(keys,hi,shape)
+    return np.minimum.reduceat(M,indptr[:-1],0),np.maximum.reduceat(M,indptr[:-1],0)
+
+def segment_std(M,indptr):
+    sizes = np.diff(indptr)
+    if sp.issparse(M):
+        M = M.tocsr()
+        shape = (len(sizes),M.shape[1])
+        keys,starts,data = _segment_entries(M,indptr)
+        if len(keys) == 0:
+            return sp.csr_matrix(shape,dtype=M.dtype)
+        counts = sizes[keys//shape[1]].astype(M.dtype)
+        mean = np.add.reduceat(data,starts)/counts
+        squares = np.add.reduceat(data*data,starts)/counts
+        return _segment_matrix(keys,np.sqrt(np.maximum(squares-mean**2,0)),shape)
+    # np.std of every segment in turn, a reduceat over all segments rounds differently and would change which
+    # of two nearly equal columns, such as p and 1-p, is split
+    std = [np.std(M[start:end],0) for start,end in zip(indptr[:-1].tolist(),indptr[1:].tolist())]
+    return np.array(std,dtype=M.dtype).reshape(len(sizes),M.shape[1])
+
+# entries M[rows[i],cols[i]] of a dense or sparse lens
+def lens_values(M,rows,cols):
+    if sp.issparse(M):
+        return np.asarray(M.tocsr()[rows,cols]).reshape(-1)
+    return M[rows,cols]
+
+def lens_column(M,col):
+    if sp.issparse(M):
+        return M[:,[col]].toarray().reshape(-1).astype(np.float64,copy=False)
+    return M[:,col].astype(np.float64,copy=False)
+
+def row_max(M):
+    if sp.issparse(M):
+        return M.max(1).toarray().reshape(-1)
+    return np.max(M,1)
+
+# column of the largest entry of every row, ties go to the first one like np.argmax; with rtol, entries
+# within rtol times the magnitude of the row maximum of it count as tied
+def row_argmax(M,rtol=0):
+    if sp.issparse(M):
+        M = M.tocsr()
+        M.sum_duplicates()
+        cols = np.asarray(M.argmax(1)).reshape(-1)
+        if rtol == 0:
+            return cols
+        # implicit zeros can only tie in rows whose maximum is 0, where argmax already picks the first column
+        hi = row_max(M)
+        thd = hi-rtol*np.abs(hi)
+        rows = np.repeat(np.arange(M.shape[0]),np.diff(M.indptr))
+        full = np.diff(M.indptr) == M.shape[1]
+        tied = np.nonzero((M.data >= thd[rows])*((thd[rows] > 0)+full[rows]))[0]
+        tied_rows,first = np.unique(rows[tied],return_index=True)
+        cols[tied_rows] = M.indices[tied[first]]
+        return cols
+    if rtol == 0:
+        return np.argmax(M,1)
+    hi = np.max(M,1,keepdims=True)
+    return np.argmax(M >= hi-rtol*np.abs(hi),1)
+
+def lens_nbytes(M):
+    if sp.issparse(M):
+        return M.data.nbytes+M.indices.nbytes+M.indptr.nbytes
+    return M.nbytes
+
+"""
+Adjacency normalized by its degrees, 1: Dinv@A, 2: A@Dinv, 3: sqrt(Dinv)@A@sqrt(Dinv),
+anything else leaves A as it is. Isolated nodes get an inverse degree of 0.
+"""
+def normalized_adjacency(A,degree_normalize=1):
+    degs = np.asarray(A.sum(0)).reshape(-1)
+    dinv = 1/degs
+    dinv[dinv==np.inf] = 0
+    Dinv = sp.spdiags(dinv,0,A.shape[0],A.shape[0])
+    if degree_normalize == 1:
+        return Dinv@A
+    elif degree_normalize == 2:
+        return A@Dinv
+    elif degree_normalize == 3:
+        Dinv_sqrt = sp.spdiags(np.sqrt(dinv),0,A.shape[0],A.shape[0])
+        return Dinv_sqrt@A@Dinv_sqrt
+    return A
+
+# csr matrix A with read-only arrays, so that it can be shared
+def _read_only(A):
+    for array in [A.data,A.indices,A.indptr]:
+        array.flags.writeable = False
+    return A
+
+# Binarized graph together with its degrees and normalized versions, computed once and kept read-only in
+# CSR with the given dtype, since operators are shared. GraphOperator.get caches operators per (graph,
+# dtype, nthreads, col_block) so that repeated compute_reeb calls on the same adjacency skip this work;
+# entries are keyed by id and hold a weak reference to the graph, and are dropped when it is collected or
+# no longer matches its shape and nnz. Only the max_cached most recently used operators are kept, so the
+# cache never holds more than a few graphs for the life of the process, and clear_cache() drops them all.
+# Products go through spmm on nthreads threads, one by default, None uses every core.
+class GraphOperator(object):
+    _cache = OrderedDict()
+    max_cached = 4
+
+    def __init__(self,A,dtype=np.float64,nthreads=1,col_block=None):
+        self.dtype = np.dtype(dtype)
+        self.nthreads = nthreads
+        self.col_block = col_block
+        self.A = _read_only((A>0).astype(self.dtype).tocsr())
+        self.degrees = np.asarray(self.A.sum(0)).reshape(-1)
+        self.degrees.flags.writeable = False
+        self._normalized = {}
+
+    @classmethod
+    def get(cls,A,dtype=np.float64,nthreads=1,col_block=None):
+        key = (id(A),np.dtype(dtype).str,nthreads,col_block)
+        entry = cls._cache.get(key)
+        if entry is not None:
+            ref,shape,nnz,operator = entry
+            if ref() is A and A.shape == shape and A.nnz == nnz:
+                cls._cache.move_to_end(key)
+                return operator
+        operator = cls(A,dtype=dtype,nthreads=nthreads,col_block=col_block)
+        cls._cache[key] = (weakref.ref(A,lambda _,key=key: cls._cache.pop(key,None)),A.shape,A.nnz,operator)
+        cls._cache.move_to_end(key)
+        while len(cls._cache) > cls.max_cached:
+            cls._cache.popitem(last=False)
+        return operator
+
+    @classmethod
+    def clear_cache(cls):
+        cls._cache.clear()
+
+    @property
+    def shape(self):
+        return self.A.shape
+
+    def normalized(self,degree_normalize=1):
+        if degree_normalize not in self._normalized:
+            An = normalized_adjacency(self.A,degree_normalize).tocsr().astype(self.dtype)
+            self._normalized[degree_normalize] = _read_only(An)
+        return self._normalized[degree_normalize]
+
+    # A@X, or An@X with degree_normalize set, through spmm with this operator's threading, a sparse X
+    # gives a csr product
+    def matmul(self,X,degree_normalize=None,nthreads=None,col_block=None):
+        A = self.A if degree_normalize is None else self.normalized(degree_normalize)
+        if sp.issparse(X):
+            return (A@X).tocsr()
+        return spmm(
+            A,X,nthreads=self.nthreads if nthreads is None else nthreads,
+            col_block=self.col_block if col_block is None else col_block)
+
+# rows bounds splitting A into nparts blocks with about the same number of nonzeros
+def row_partition(A,nparts):
+    targets = np.linspace(0,A.nnz,nparts+1)
+    bounds = np.searchsorted(A.indptr,targets,side="left")
+    bounds[0],bounds[-1] = 0,A.shape[0]
+    return np.unique(np.minimum(bounds,A.shape[0]))
+
+# rows start:end of a csr matrix sharing its index and data arrays
+def csr_row_block(A,start,end):
+    ptr = A.indptr[start:(end+1)]
+    block = sp.csr_matrix((end-start,A.shape[1]),dtype=A.dtype)
+    block.indptr = ptr-ptr[0]
+    block.indices = A.indices[ptr[0]:ptr[-1]]
+    block.data = A.data[ptr[0]:ptr[-1]]
+    return block
+
+"""
+Sparse-times-dense product A@X computed by a pool of nthreads threads, each taking a block of rows of A
+with a balanced number of nonzeros. With col_block set, X is also cut into blocks of that many columns so
+that the rows of X touched by a block stay in cache. Every output row is summed in the same order as A@X,
+so the result is identical to it. Small products, where threads would not pay off, are done directly.
+"""
+def spmm(A,X,nthreads=1,col_block=None,min_work=1<<20):
+    A = A.tocsr()
+    nthreads = (os.cpu_count() or 1) if nthreads is None else nthreads
+    ncols = int(np.prod(X.shape[1:]))
+    if (nthreads <= 1 and col_block is None) or A.nnz*ncols < max(min_work,1):
+        return A@X
+    shape = (A.shape[0],)+X.shape[1:]
+    X = X.reshape(X.shape[0],ncols)
+    bounds = row_partition(A,max(nthreads,1))
+    if col_block is None or col_block >= ncols:
+        col_slices = [slice(None)]
+    else:
+        col_slices = [slice(c,c+col_block) for c in range(0,ncols,col_block)]
+    X_blocks = [X if c == slice(None) else np.ascontiguousarray(X[:,c]) for c in col_slices]
+    out = np.empty((A.shape[0],ncols),dtype=np.result_type(A.dtype,X.dtype))
+    def worker(start,end):
+        block = csr_row_block(A,start,end)
+        for c,X_block in zip(col_slices,X_blocks):
+            out[start:end,c] = block@X_block
+    if nthreads <= 1:
+        for start,end in zip(bounds[:-1],bounds[1:]):
+            worker(start,end)
+    else:
+        with ThreadPoolExecutor(max_workers=nthreads) as pool:
+            list(pool.map(worker,bounds[:-1],bounds[1:]))
+    return out.reshape(shape)
+
+"""
+Diffusion X = (1-alpha)*init + alpha*An@X of init over a graph A (a sparse matrix or a GraphOperator)
+normalized as in normalized_adjacency. init can be a sparse (csr) matrix for method="power", X is then
+a csr matrix as well whose nonzeros spread along the graph with every step. With topk set, every row of
+X keeps only its topk largest entries among the first topk_cols columns (all of them if None) after each
+step, like the top-k lens it starts from, so that X stays as sparse as init; init must then be sparse.
+method="power" runs the iteration from X = init for nsteps steps, or stops earlier once the relative
+change of an update drops below tol. method="cg" solves for the fixed point itself with Jacobi
+preconditioned conjugate gradients on the symmetric system (D'-alpha*A)Y = (1-alpha)*D'^s*init, where
+D' is the degree matrix with isolated nodes set to 1 and X = D'^t*Y (s, t depend on degree_normalize),
+for at most nsteps iterations or until the relative residual drops below tol. It needs a symmetric A
+and degree_normalize in 1, 2, 3 and a dense init, and iterates in float64 whatever the dtype of init, which X is cast back to.
+Returns X and a dict with the iterations and the residual of the last one.
+"""
+def diffuse(A,init,alpha=0.5,nsteps=10,degree_normalize=1,tol=None,method="power",topk=None,topk_cols=None,
+    verbose=False):
+    operator = A if isinstance(A,GraphOperator) else GraphOperator(A)
+    if topk is not None and (method != "power" or not sp.issparse(init)):
+        raise ValueError("topk diffusion needs a sparse init and method=\"power\"")
+    if method == "power":
+        X = init.copy()
+        norm = sp.linalg.norm if sp.issparse(init) else np.linalg.norm
+        residual = np.inf
+        iterations = 0
+        for _ in tqdm(range(nsteps),disable=1-verbose):
+            X_next = (1-alpha)*init + alpha*operator.matmul(X,degree_normalize)
+            if topk is not None:
+                X_next = _topk_columns(X_next,topk,X_next.shape[1] if topk_cols is None else topk_cols)
+            iterations += 1
+            residual = float(norm(X_next-X)/max(norm(X_next),np.finfo(np.float64).tiny))
+            X = X_next
+            if tol is not None and residual <= tol:
+                break
+        return X,{"iterations":iterations,"residual":residual}
+    elif method != "cg":
+        raise ValueError("Unknown diffusion method {}".format(method))
+    if degree_normalize not in (1,2,3):
+        raise ValueError("cg diffusion needs degree_normalize in 1, 2, 3")
+    if sp.issparse(init):
+        raise ValueError("cg diffusion needs a dense init, use method=\"power\" for sparse lenses")
+    degs = operator.degrees.astype(np.float64)
+    degs[degs==0] = 1
+    rhs_scale,x_scale = {1:(degs,1),2:(1,degs),3:(np.sqrt(degs),np.sqrt(degs))}[degree_normalize]
+    S = (sp.diags(degs)-alpha*operator.A).tocsr()
+    diag = S.diagonal()
+    out_dtype = np.asarray(init).dtype
+    init = np.asarray(init,dtype=np.float64)
+    squeeze = init.ndim == 1
+    B = (1-alpha)*(init.reshape(init.shape[0],-1)*np.reshape(rhs_scale,(-1,1)))
+    Y = np.zeros_like(B)
+    R = B.copy()
+    Z = R/diag[:,None]
+    P = Z.copy()
+    rz = np.sum(R*Z,0)
+    rhs_norms = np.linalg.norm(B,axis=0)
+    rhs_norms[rhs_norms==0] = 1
+    residual = float(np.max(np.linalg.norm(R,axis=0)/rhs_norms)) if B.shape[1] > 0 else 0.0
+    iterations = 0
+    for _ in tqdm(range(nsteps),disable=1-verbose):
+        if tol is not None and residual <= tol:
+            break
+        SP = spmm(S,P,nthreads=operator.nthreads,col_block=operator.col_block)
+        pSp = np.sum(P*SP,0)
+        step = np.divide(rz,pSp,out=np.zeros_like(rz),where=pSp>0)
+        Y += P*step
+        R -= SP*step
+        iterations += 1
+        residual = float(np.max(np.linalg.norm(R,axis=0)/rhs_norms))
+        Z = R/diag[:,None]
+        rz_next = np.sum(R*Z,0)
+        P = Z+P*np.divide(rz_next,rz,out=np.zeros_like(rz),where=rz>0)
+        rz = rz_next
+    X = (Y*np.reshape(x_scale,(-1,1))).astype(out_dtype,copy=False)
+    return (X.reshape(-1) if squeeze else X),{"iterations":iterations,"residual":residual}
+
+"""
+Symmetric CSR holding distance e[k] at (ei[k], ej[k]) and (ej[k], ei[k]) for the upper triangle edges
+ei <= ej, built in one pass with sorted indices. Only edges with 0 < e < merge_thd are kept, which is
+what summing the triangle with its transpose used to leave since the sum drops zeros.
+"""
+def symmetric_edge_matrix(ei,ej,e,n,merge_thd=1.0,index_dtype=None):
+    keep = (e < merge_thd)&(e != 0)
+    rows = np.r_[ei[keep],ej[keep]]
+    cols = np.r_[ej[keep],ei[keep]]
+    data = np.r_[e[keep],e[keep]]
+    order = np.lexsort((cols,rows))
+    index_dtype = get_index_dtype(max(n,len(rows)),index_dtype)
+    indptr = np.zeros(n+1,dtype=index_dtype)
+    np.cumsum(np.bincount(rows,minlength=n),out=indptr[1:])
+    return sp.csr_matrix((data[order],cols[order].astype(index_dtype),indptr),shape=(n,n))
+
+"""
+Max absolute lens difference between the endpoints of every edge of A, as the symmetric edges_dists
+of symmetric_edge_matrix, in the dtype of M, which can be dense or a sparse lens. Runs on the CPU with numpy over int32 edge arrays (int64 on
+huge graphs, or index_dtype if given), in chunks of edges whose gathered lens rows fit in max_bytes, spread over nthreads threads (None uses
+every core).
+"""
+def edge_distances(M,A,merge_thd=1.0,max_bytes=1<<27,nthreads=None,index_dtype=None):
+    n = A.shape[0]
+    index_dtype = get_index_dtype(n,index_dtype)
+    Au = sp.triu(A).tocoo()
+    ei,ej = Au.row.astype(index_dtype),Au.col.astype(index_dtype)
+    e = np.zeros(len(ei),dtype=M.dtype)
+    if sp.issparse(M):
+        M = M.tocsr()
+        row_bytes = max(M.nnz/max(n,1),1)*(M.dtype.itemsize+M.indices.itemsize)
+    else:
+        row_bytes = M.shape[1]*M.itemsize
+    chunk = max(1,int(max_bytes//max(2*row_bytes,1)))
+    def worker(start):
+        end = min(start+chunk,len(ei))
+        if M.shape[1] == 0:
+            return
+        if sp.issparse(M):
+            # entries stored in only one of the rows are compared against an implicit zero
+            e[start:end] = abs(M[ei[start:end]]-M[ej[start:end]]).max(1).toarray().reshape(-1)
+        else:
+            np.max(np.abs(M[ei[start:end]]-M[ej[start:end]]),1,out=e[start:end])
+    starts = range(0,len(ei),chunk)
+    nthreads = (os.cpu_count() or 1) if nthreads is None else nthreads
+    if nthreads <= 1 or len(starts) <= 1:
+        for start in starts:
+            worker(start)
+    else:
+        with ThreadPoolExecutor(max_workers=nthreads) as pool:
+            list(pool.map(worker,starts))
+    return symmetric_edge_matrix(ei,ej,e,n,merge_thd,index_dtype)
+
+"""
+Splitting, merging and reeb graph construction on a GTDA object whose lens M is already preprocessed.
+edges_dists is the symmetric edge distance matrix (or a NeighborIndex built from it). If reeb_nodes
+is given, splitting is skipped and merging starts from these unique components instead.
+Returns the reeb graph over all reeb node keys and the extra edges added while merging.
+"""
+def build_reeb_stages(gtda,M,Ar,edges_dists,smallest_component,overlap,node_size_thd=5,reeb_component_thd=5,
+    split_criteria='diff',split_thd=0,max_split_iters=200,max_merge_iters=10,is_merging=True,nprocs=1,
+    split_backend="threading",verbose=False,reeb_nodes=None):
+    with gtda.profiler.stage("neighbor_index"):
+        neighbor_index = edges_dists if isinstance(edges_dists,NeighborIndex) else NeighborIndex(edges_dists)
+    if reeb_nodes is None:
+        split_reeb_nodes(
+            gtda,M,Ar,smallest_component,overlap,node_size_thd=node_size_thd,split_criteria=split_criteria,
+            split_thd=split_thd,max_split_iters=max_split_iters,nprocs=nprocs,split_backend=split_backend,
+            verbose=verbose)
+    else:
+        gtda.final_components_unique = reeb_nodes
+        gtda._filter_tiny_components(Ar,node_size_thd,verbose)
+    if is_merging:
+        gtda.merge_reeb_nodes(
+            Ar,M,niters=max_merge_iters,node_size_thd=node_size_thd,edges_dists=neighbor_index,verbose=verbose)
+    if len(gtda.final_components_filtered) == 0:
+        gtda.filtered_nodes = np.zeros(0,dtype=np.int64)
+        return sp.csr_matrix((0,0),dtype=gtda.dtype),[[],[]]
+    return gtda.build_reeb_graph(
+        M,Ar,reeb_component_thd=reeb_component_thd,max_iters=max_merge_iters,is_merging=is_merging,
+        edges_dists=neighbor_index,verbose=verbose)
+
+def split_reeb_nodes(gtda,M,Ar,smallest_component,overlap,node_size_thd=5,split_criteria='diff',split_thd=0,
+    max_split_iters=200,nprocs=1,split_backend="threading",verbose=False):
+    gtda.find_reeb_nodes(
+        M,Ar,smallest_component=smallest_component,
+        filter_cols=list(range(M.shape[1])),overlap=overlap,component_size_thd=0,
+        node_size_thd=node_size_thd,split_criteria=split_criteria,
+        split_thd=split_thd,max_iters=max_split_iters,nprocs=nprocs,backend=split_backend,verbose=verbose)
+
+"""
+Node sets of nshards shards made of whole connected components of A. Components are packed largest
+first into the currently smallest shard, and the nodes of every shard are kept in increasing order so
+that ties inside a shard are broken as in an unsharded run. Empty shards are dropped.
+"""
+def shard_components(A,nshards):
+    labels,indptr,members = find_components_array(A,size_thd=0)
+    sizes = np.diff(indptr)
+    loads = np.zeros(nshards,dtype=np.int64)
+    assignment = np.zeros(len(sizes),dtype=np.int64)
+    for c in np.argsort(-sizes,kind="stable"):
+        shard = np.argmin(loads)
+        assignment[c] = shard
+        loads[shard] += sizes[c]
+    node_shards = assignment[labels]
+    return [np.nonzero(node_shards == shard)[0] for shard in range(nshards) if loads[shard] > 0]
+
+# output of a shard worker, which only reaches the terminal with verbose
+def _shard_output(verbose):
+    return contextlib.nullcontext() if verbose else contextlib.redirect_stdout(io.StringIO())
+
+# splitting of one shard in a worker, with node indices local to the shard
+def split_reeb_shard(GTDA,M,Ar,labels_to_eval,split_params,dtype=np.float64,index_dtype=None,verbose=False):
+    shard_model = NN_model()
+    shard_model.A = Ar
+    shard_model.preds = M
+    gtda = GTDA(shard_model,labels_to_eval,dtype=dtype,index_dtype=index_dtype)
+    with _shard_output(verbose):
+        split_reeb_nodes(gtda,M,Ar,verbose=verbose,**split_params)
+    return {
+        "final_components_unique": gtda.final_components_unique,
+        "component_records": gtda.component_records,
+        "final_components": gtda.final_components,
+        "split_lens": gtda.split_lens,
+        "component_counts": gtda.component_counts,
+        "component_id_map": dict(gtda.component_id_map),
+        "profile": gtda.profiler.to_dict(),
+    }
+
+"""
+Unique components of all shards renumbered as an unsharded run numbers them, in lexicographic order of
+their global members over all shards. Returns one store per shard holding the shard's local members
+under the global keys, in increasing key order.
+"""
+def number_shard_reeb_nodes(shards,stores,n,index_dtype=None):
+    shard_keys,indptrs,members = [],[],[]
+    for nodes,store in zip(shards,stores):
+        keys = list(store.keys())
+        indptr,shard_members = store.gather(keys)
+        shard_keys.append(keys)
+        indptrs.append(indptr)
+        members.append(nodes[shard_members])
+    sizes = np.concatenate([np.diff(indptr) for indptr in indptrs]).astype(np.int64)
+    order = lexicographic_order(np.r_[0,np.cumsum(sizes)].astype(np.int64),np.concatenate(members))
+    ids = np.empty(len(order),dtype=np.int64)
+    ids[order] = np.arange(len(order))
+    offsets = np.r_[0,np.cumsum([len(keys) for keys in shard_keys])]
+    index_dtype = get_index_dtype(n,index_dtype)
+    return [
+        ComponentStore.from_csr(ids[offsets[i]:offsets[i+1]].tolist(),indptrs[i],stores[i].gather()[1],dtype=index_dtype)
+        for i in range(len(stores))]
+
+# merging and reeb graph of one shard in a worker, from reeb nodes that already carry global keys;
+# the shard keeps its samples in ascending order, so ties are broken as in an unsharded run
+def compute_reeb_shard(GTDA,M,Ar,edges_dists,nodes,reeb_nodes,labels_to_eval,reeb_params,dtype=np.float64,
+    index_dtype=None,verbose=False):
+    shard_model = NN_model()
+    shard_model.A = Ar
+    shard_model.preds = M
+    gtda = GTDA(shard_model,labels_to_eval,dtype=dtype,index_dtype=index_dtype)
+    with _shard_output(verbose):
+        g_reeb_orig,extra_edges = build_reeb_stages(
+            gtda,M,Ar,edges_dists,reeb_nodes=reeb_nodes,verbose=verbose,**reeb_params)
+    return {
+        "final_components_filtered": gtda.final_components_filtered,
+        "final_components_removed": gtda.final_components_removed,
+        "edges_to_merge": getattr(gtda,"edges_to_merge",[]),
+        "filtered_nodes": np.asarray(gtda.filtered_nodes,dtype=np.int64),
+        "g_reeb_orig": g_reeb_orig,
+        "extra_edges": extra_edges,
+        "profile": gtda.profiler.to_dict(),
+    }
+
+# store with the members of every shard's store mapped to global node indices, keys shifted by offsets
+# and in increasing order
+def _stitch_stores(shards,stores,offsets,dtype):
+    keys,sizes,members = [],[],[]
+    for nodes,store,offset in zip(shards,stores,offsets):
+        shard_keys = list(store.keys())
+        indptr,shard_members = store.gather(shard_keys)
+        keys += (np.asarray(shard_keys,dtype=np.int64)+offset).tolist()
+        sizes.append(np.diff(indptr))
+        members.append(nodes[shard_members])
+    indptr = np.r_[0,np.cumsum(np.concatenate(sizes))].astype(np.int64)
+    store = ComponentStore.from_csr(keys,indptr,np.concatenate(members),dtype=dtype)
+    return store if np.all(np.diff(keys) > 0) else store.subset(np.sort(keys).tolist())
+
+"""
+Merge shard results into gtda. Reeb node keys are global already, node indices are mapped back through
+the shard's node set, so the stitched stores, filtered nodes, reeb graph and extra edges are those of an
+unsharded run. The splitting records of shard s (component_records, final_components, split_lens and
+component_id_map) are shifted by the record and final component keys of the shards before it, and
+component_counts holds the number of records over all shards after each level.
+"""
+def stitch_reeb_shards(gtda,shards,reeb_nodes,split_results,results,n):
+    index_dtype = get_index_dtype(n,gtda.index_dtype)
+    zeros = [0]*len(shards)
+    gtda.final_components_unique = _stitch_stores(shards,reeb_nodes,zeros,index_dtype)
+    for name in ["final_components_filtered","final_components_removed"]:
+        setattr(gtda,name,_stitch_stores(shards,[result[name] for result in results],zeros,index_dtype))
+    record_offsets = np.r_[0,np.cumsum(
+        [max(result["component_records"].keys(),default=-1)+1 for result in split_results])].astype(np.int64)
+    final_offsets = np.r_[0,np.cumsum([len(result["final_components"]) for result in split_results])].astype(np.int64)
+    gtda.component_records = _stitch_stores(
+        shards,[result["component_records"] for result in split_results],record_offsets,index_dtype)
+    gtda.final_components = _stitch_stores(
+        shards,[result["final_components"] for result in split_results],final_offsets,index_dtype)
+    gtda.component_records_all = {}
+    gtda.final_components_all = {}
+    gtda.split_lens = {
+        k+offset: col for result,offset in zip(split_results,record_offsets.tolist())
+        for k,col in result["split_lens"].items()}
+    gtda.component_id_map = defaultdict(list)
+    for result,offset in zip(split_results,record_offsets.tolist()):
+        for k,children in result["component_id_map"].items():
+            gtda.component_id_map[k+offset] = [child+offset for child in children]
+    nlevels = max([len(result["component_counts"]) for result in split_results]+[1])
+    gtda.component_counts = np.sum([
+        result["component_counts"]+result["component_counts"][-1:]*(nlevels-len(result["component_counts"]))
+        for result in split_results],axis=0).tolist()
+    nnodes = len(gtda.final_components_unique)
+    gtda.node_assignments = NodeAssignments.from_components(
+        gtda.final_components_filtered,list(gtda.final_components_filtered.keys()),n,nnodes)
+    gtda.node_assignments_tiny_components = NodeAssignments.from_components(
+        gtda.final_components_removed,list(gtda.final_components_removed.keys()),n,nnodes)
+    gtda.edges_to_merge = [edge for result in results for edge in result["edges_to_merge"]]
+    gtda.filtered_nodes = np.sort(np.concatenate([result["filtered_nodes"] for result in results])).astype(np.int64)
+    reeb_dim = max([result["g_reeb_orig"].shape[0] for result in results]+[0])
+    ei,ej = [],[]
+    extra_edges = [[],[]]
+    for nodes,result in zip(shards,results):
+        g = result["g_reeb_orig"].tocoo()
+        ei.append(g.row.astype(np.int64))
+        ej.append(g.col.astype(np.int64))
+        extra_edges[0] += nodes[np.asarray(result["extra_edges"][0],dtype=np.int64)].tolist()
+        extra_edges[1] += nodes[np.asarray(result["extra_edges"][1],dtype=np.int64)].tolist()
+    ei,ej = np.concatenate(ei),np.concatenate(ej)
+    g_reeb_orig = sp.csr_matrix((np.ones(len(ei),dtype=gtda.dtype),(ei,ej)),shape=(reeb_dim,reeb_dim))
+    return g_reeb_orig,extra_edges
+
 """
 GTDA: our GTDA framework class
 nn_model: an instance of NN_model class
@@ -296,8 +1468,15 @@ smallest_component: Int
 overlap: Tuple(Float,Float) or Float, overlap ratio. 
     -- If it is a tuple, first item represents how much to extend the left side of a bin, second is how much to extend the right side of a bin
     -- If overlapping ratio is (r1,r2) and current bin size is s, after splitting, left bin has size s*(1+r2)/2, right bin has size s*(1+r1)/2
-extra_lens: Numpy array
+extra_lens: Numpy array or sparse matrix
     -- any extra lens to use for splitting
+    -- nn_model.preds and extra_lens can be sparse (see topk_lens), which keeps the lens, its diffusion and the
+    -- error estimation sparse, is_normalize and is_standardize then only scale the lens columns; splitting, binning
+    -- and merging only look at differences of lens values, which round differently without the shift, so near ties
+    -- between split columns can be broken otherwise than for the dense lens
+lens_topk: Int or None
+    -- keep only the lens_topk largest entries of every row of nn_model.preds, making the lens sparse, and again
+    -- after every step of the lens preprocess so that diffusion does not fill it in; extra_lens is used as given
 node_size_thd: Int
     -- all Reeb net nodes will have size larger than this number after merging
 reeb_component_thd: Int
@@ -328,48 +1507,116 @@ max_merge_iters: Int
 degree_normalize_preprocess: Int, choose among 1, 2, 3
     -- an experimental parameter to normalize the graph in different ways during preprocess and error estimation
     -- default is Dinv@A, set to 2 to use A@Dinv, set to 3 to use np.sqrt(Dinv)@A@np.sqrt(Dinv), where A is adjacency matrix, Dinv is inverse degree matrix
+nprocs: Int
+    -- number of workers used to split the components of each level, and to run the shards when nshards is set;
+    -- merging reeb nodes and building the reeb graph run in the calling process; the sparse products of the lens
+    -- preprocess and of the mixing rate diffusion and the edge distances use nprocs threads
+split_backend: String
+    -- joblib backend used to split components in parallel, "threading" shares memory with the main process but only
+    -- overlaps the parts that release the GIL (numpy sorts, scipy connected components), "loky" uses a process pool
+    -- and sends every worker one task per level holding the level's lens values and subgraphs, which joblib memmaps
+    -- into shared memory when they are large; workers import this package (and torch) when the pool starts, so
+    -- levels with fewer samples to split than GTDA.parallel_min_samples stay in the calling process;
+    -- results are identical to a serial run either way
+nshards: Int or None
+    -- split the graph into this many shards of whole connected components, packed to balanced sizes, and build
+    -- the reeb net of every shard in its own worker (nprocs at a time), lens preprocess and error estimation stay global;
+    -- shards are split, their reeb nodes numbered as in an unsharded run and then merged, so the result is the same;
+    -- a graph with a single shard, e.g. a connected one, is built in the calling process as if nshards were None
+shard_backend: String
+    -- joblib backend used to run the shards, "loky" runs them in worker processes
+profile_hook: callable or None
+    -- called as profile_hook(event, record) when a stage starts or stops, the full profile of wall time, CPU time
+    -- and RSS change per stage and the counters is returned as GTDA_record["profile"]
+device: String or None
+    -- torch device used to compute lens distances along edges, "cpu" or None computes them with numpy threads instead,
+    -- which is always the case for sparse lenses
+diffusion_tol: Float or None
+    -- stop lens preprocess and error estimation once the relative residual is below this value,
+    -- nsteps_preprocess and nsteps_mixing then only bound the number of iterations
+dtype: numpy float dtype
+    -- dtype of the lens, the graph operators, edge distances and the reeb graphs, np.float32 halves their memory,
+    -- bins are still assigned by comparing the lens with float64 bin boundaries, results in float32 are approximate,
+    -- splits of lens ranges close to float32 resolution and a few extra edges can differ from float64
+index_dtype: numpy integer dtype or None
+    -- dtype of node indices in components and sparse matrices, None picks int32 whenever the graph fits
+diffusion_method: String
+    -- "power" iterates the diffusion step by step, "cg" solves for its fixed point with conjugate gradients,
+    -- which converges in fewer iterations but is not the same as stopping after a few power steps
 
 Note: if the original graph is not connected, it's possible that some components cannot pass the splitting or minimum reeb net component threshold and hence not included in the reeb net
 """
 def compute_reeb(GTDA,nn_model,labels_to_eval,smallest_component,overlap,extra_lens=None,
     node_size_thd=5,reeb_component_thd=5,alpha=0.5,nsteps_preprocess=5,nsteps_mixing=10,is_merging=True,
     split_criteria='diff',split_thd=0,is_normalize=True,is_standardize=False,merge_thd=1.0,max_split_iters=200,
-    max_merge_iters=10,nprocs=1,device='cuda',degree_normalize_preprocess=1,degree_normalize_mixing=1,verbose=False):
+    max_merge_iters=10,nprocs=1,split_backend="threading",device='cuda',degree_normalize_preprocess=1,
+    degree_normalize_mixing=1,verbose=False,diffusion_tol=None,diffusion_method="power",nshards=None,
+    shard_backend="loky",profile_hook=None,dtype=np.float64,index_dtype=None,lens_topk=None):
     if isinstance(overlap,tuple) == False:
         assert(overlap > 0)
         assert(overlap < 1)
         overlap = (0,overlap)
     t1 = time.time()
-    gtda = GTDA(nn_model,labels_to_eval)
+    gtda = GTDA(nn_model,labels_to_eval,dtype=dtype,index_dtype=index_dtype,lens_topk=lens_topk)
+    profiler = StageProfiler(hook=profile_hook)
+    gtda.profiler = profiler
     print("Preprocess lens..")
     M,Ar = gtda.build_mixing_matrix(
         alpha=alpha,nsteps=nsteps_preprocess,extra_lens=extra_lens,normalize=is_normalize,
-        standardize=is_standardize,degree_normalize=degree_normalize_preprocess,verbose=verbose)
-    M = torch.tensor(M).to(device)
+        standardize=is_standardize,degree_normalize=degree_normalize_preprocess,
+        tol=diffusion_tol,method=diffusion_method,nthreads=nprocs,verbose=verbose)
     A_knn = nn_model.A
-    Au = sp.triu(A_knn).tocoo()
-    ei,ej = Au.row,Au.col
-    e = []
-    n = A_knn.shape[0]
-    for i in tqdm(range(0,Au.nnz,10000),disable=1-verbose):
-        start_i = i
-        end_i = min(start_i+10000,Au.nnz)
-        e.append(torch.max(torch.abs((
-            M[ei[start_i:end_i],:]-M[ej[start_i:end_i],:])),1)[0].cpu().detach().numpy())
-    e = np.concatenate(e)
-    selected_edges = np.nonzero(e<merge_thd)[0]
-    edges_dists = sp.csr_matrix((e[selected_edges],(ei[selected_edges],ej[selected_edges])),shape=(n,n))
-    edges_dists = edges_dists+edges_dists.T
-    M = M.cpu().numpy()
-    gtda.find_reeb_nodes(
-        M,Ar,smallest_component=smallest_component,
-        filter_cols=list(range(M.shape[1])),overlap=overlap,component_size_thd=0,
-        node_size_thd=node_size_thd,split_criteria=split_criteria,
-        split_thd=split_thd,max_iters=max_split_iters,verbose=verbose)
-    if is_merging:
-        gtda.merge_reeb_nodes(Ar,M,niters=max_merge_iters,node_size_thd=node_size_thd,edges_dists=edges_dists,nprocs=nprocs,verbose=verbose)
-    g_reeb_orig,extra_edges = gtda.build_reeb_graph(
-        M,Ar,reeb_component_thd=reeb_component_thd,max_iters=max_merge_iters,is_merging=is_merging,edges_dists=edges_dists,verbose=verbose)
+    with profiler.stage("edge_distances",device=str(device)) as edge_stage:
+        if device is None or str(device) == 'cpu' or sp.issparse(M):
+            edges_dists = edge_distances(M,A_knn,merge_thd=merge_thd,nthreads=nprocs,index_dtype=index_dtype)
+        else:
+            M = torch.tensor(M).to(device)
+            Au = sp.triu(A_knn).tocoo()
+            ei,ej = Au.row,Au.col
+            e = []
+            n = A_knn.shape[0]
+            for i in tqdm(range(0,Au.nnz,10000),disable=1-verbose):
+                start_i = i
+                end_i = min(start_i+10000,Au.nnz)
+                e.append(torch.max(torch.abs((
+                    M[ei[start_i:end_i],:]-M[ej[start_i:end_i],:])),1)[0].cpu().detach().numpy())
+            e = np.concatenate(e) if len(e) > 0 else np.zeros(0,dtype=gtda.dtype)
+            edges_dists = symmetric_edge_matrix(ei,ej,e,n,merge_thd=merge_thd,index_dtype=index_dtype)
+            M = M.cpu().numpy()
+        edge_stage["info"].update(edges=edges_dists.nnz//2)
+    split_params = dict(
+        smallest_component=smallest_component,overlap=overlap,node_size_thd=node_size_thd,
+        split_criteria=split_criteria,split_thd=split_thd,max_split_iters=max_split_iters)
+    reeb_params = dict(
+        split_params,reeb_component_thd=reeb_component_thd,max_merge_iters=max_merge_iters,is_merging=is_merging)
+    # a graph that does not split into several shards, e.g. a connected one, is built as a whole
+    shards = shard_components(Ar,nshards) if nshards is not None and nshards > 1 else []
+    if len(shards) <= 1:
+        g_reeb_orig,extra_edges = build_reeb_stages(
+            gtda,M,Ar,edges_dists,nprocs=nprocs,split_backend=split_backend,verbose=verbose,**reeb_params)
+    else:
+        # shards are split first, merged once their reeb nodes carry the keys of an unsharded run
+        with profiler.stage("shards",nshards=nshards) as shard_stage:
+            split_results = Parallel(n_jobs=nprocs,backend=shard_backend)(
+                delayed(split_reeb_shard)(
+                    GTDA,M[nodes],Ar[nodes,:][:,nodes],labels_to_eval,split_params,dtype=dtype,index_dtype=index_dtype,
+                    verbose=verbose)
+                for nodes in shards)
+            reeb_nodes = number_shard_reeb_nodes(
+                shards,[result["final_components_unique"] for result in split_results],Ar.shape[0],index_dtype)
+            results = Parallel(n_jobs=nprocs,backend=shard_backend)(
+                delayed(compute_reeb_shard)(
+                    GTDA,M[nodes],Ar[nodes,:][:,nodes],edges_dists[nodes,:][:,nodes],nodes,shard_nodes,
+                    labels_to_eval,reeb_params,dtype=dtype,index_dtype=index_dtype,verbose=verbose)
+                for nodes,shard_nodes in zip(shards,reeb_nodes))
+            g_reeb_orig,extra_edges = stitch_reeb_shards(gtda,shards,reeb_nodes,split_results,results,Ar.shape[0])
+            shard_stage["info"]["shard_sizes"] = [len(nodes) for nodes in shards]
+            shard_stage["info"]["shard_profiles"] = [
+                {"split":split_result["profile"],"merge":result["profile"]}
+                for split_result,result in zip(split_results,results)]
+            for result in split_results+results:
+                for name,value in result["profile"]["counters"].items():
+                    profiler.count(name,value)
     filtered_nodes = gtda.filtered_nodes
     g_reeb = g_reeb_orig[filtered_nodes,:][:,filtered_nodes]
     t2 = time.time()
@@ -377,14 +1624,16 @@ def compute_reeb(GTDA,nn_model,labels_to_eval,smallest_component,overlap,extra_l
     print(f"Total time for building reeb graph is {time_of_building_reeb_graph} seconds")
     print("Compute mixing rate for each sample")
     gtda.generate_node_info(
-        nn_model,Ar,g_reeb_orig,extra_edges=extra_edges,class_colors=None,
-        nsteps=nsteps_mixing,degree_normalize=degree_normalize_mixing)
+        nn_model,Ar,extra_edges=extra_edges,class_colors=None,
+        nsteps=nsteps_mixing,degree_normalize=degree_normalize_mixing,tol=diffusion_tol,method=diffusion_method,
+        nthreads=nprocs)
     GTDA_record = {
         "g_reeb": g_reeb,
         "gtda": gtda,
         "extra_edges": extra_edges,
         "time_of_building_reeb_graph": time_of_building_reeb_graph,
         "M": M,
+        "profile": profiler.to_dict(),
     }
     return GTDA_record
 
@@ -594,13 +1843,10 @@ def save_to_json(GTDA_record,nn_model,savepath,class_names,filename="reeb_net.js
     links = []
     node_set = defaultdict(list)
     link_set = set()
-    pred_labels = np.argmax(nn_model.preds,1)
+    pred_labels = row_argmax(nn_model.preds)
     labels = nn_model.labels
     gtda = GTDA_record['gtda']
-    A_reeb_components = find_components(gtda.A_reeb,size_thd=0)[1]
-    node_to_cid = np.zeros(gtda.A_reeb.shape[0],dtype=int)
-    for i,c in enumerate(A_reeb_components):
-        node_to_cid[c] = i
+    node_to_cid,_,_ = find_components_array(gtda.A_reeb,size_thd=0)
     for i in range(len(gtda.filtered_nodes)):
         for node_id in gtda.final_components_filtered[gtda.filtered_nodes[i]]:
             node_set[int(node_id)].append(int(i))
@@ -1,4 +1,4 @@
-from .GTDA_utils import find_components
+from .GTDA_utils import find_components_array, ComponentStore, overlap_adjacency, get_index_dtype
 import numpy as np
 import scipy.sparse as sp
 from collections import defaultdict, Counter
@@ -114,7 +114,7 @@ class TDA(object):
 
     def find_reeb_nodes(self,M,Ar,nbins=2,overlap=0.1,cluster_fn=None):
         self.bins = self._find_bins(M,overlap,nbins)
-        self.final_components = {}
+        self.final_components = ComponentStore(dtype=get_index_dtype(Ar.shape[0]))
         self.component_bin_id = {}
         self.bin_component_id = defaultdict(list)
         self.num_total_components = 0
@@ -129,39 +129,24 @@ class TDA(object):
                         components[l].append(i)
                 components = list(components.values())
             else:
-                _,components = find_components(Ar[curr_bin,:][:,curr_bin],size_thd=0)
+                _,indptr,members = find_components_array(Ar[curr_bin,:][:,curr_bin],size_thd=0)
+                components = [members[indptr[i]:indptr[i+1]] for i in range(len(indptr)-1)]
             for component in components:
-                self.final_components[self.num_total_components] = curr_bin[component].tolist()
+                self.final_components[self.num_total_components] = curr_bin[component]
                 self.component_bin_id[self.num_total_components] = bin_id
                 self.bin_component_id[bin_id].append(self.num_total_components)
                 self.num_total_components += 1
         self._remove_duplicate_components()
     
     def _remove_duplicate_components(self):
-        all_c = sorted([
-            sorted(self.final_components[key]) for key in self.final_components.keys()])
-        filtered_c = list(k for k,_ in itertools.groupby(all_c))
-        self.final_components_unique = {i:c for i,c in enumerate(filtered_c)}
+        self.final_components_unique = self.final_components.unique()
 
-    def build_reeb_graph(self,M):
-        all_edge_index = [[], []]
+    def build_reeb_graph(self,M,max_bytes=None):
         print("Build reeb graph...")
         reeb_dim = np.max(list(self.final_components_unique.keys()))+1
-        ei,ej = [],[]
-        for key,c in self.final_components_unique.items():
-            ei += [key]*len(c)
-            ej += c
-        bipartite_g = sp.csr_matrix((np.ones(len(ei)),(ei,ej)),shape=(reeb_dim,M.shape[0]))
-        bipartite_g_t = bipartite_g.T.tocsr()
-        ei,ej = [],[]
-        for i in tqdm(self.final_components_unique.keys(),disable=1-self.verbose):
-            neighs = set(bipartite_g_t[bipartite_g[i,:].indices].indices)
-            neighs.remove(i)
-            neighs = list(neighs)
-            all_edge_index[0] += [i]*len(neighs)
-            all_edge_index[1] += neighs
-        A_tmp = sp.csr_matrix(
-            (np.ones(len(all_edge_index[1])),(all_edge_index[0],all_edge_index[1])),shape=(
-                reeb_dim,reeb_dim))
-        A_tmp = ((A_tmp+A_tmp.T)>0).astype(np.float64)
+        keys = list(self.final_components_unique.keys())
+        indptr,members = self.final_components_unique.gather(keys)
+        bipartite_g = sp.csr_matrix(
+            (np.ones(len(members)),(np.repeat(keys,np.diff(indptr)),members)),shape=(reeb_dim,M.shape[0]))
+        A_tmp = overlap_adjacency(bipartite_g,max_bytes=max_bytes)
         return A_tmp
\ No newline at end of file
@@ -0,0 +1,269 @@
+"""
+This file benchmarks the Reeb network engines, GTDA through compute_reeb and the mapper-style TDA class,
+on the graphs under 'dataset/precomputed' and on synthetic graphs with softmax lenses: a stochastic block
+model ("sbm") and a kNN graph of a gaussian mixture ("knn"), whose sizes are set with --sizes, e.g.
+    python benchmark_reeb.py --sizes 10000 100000 1000000 10000000 --output results.json
+Every case runs in a fresh process so that its peak RSS is its own. Wall time, CPU time and the change of
+RSS are recorded for every stage together with the engine counters, and the fastest of --repeat runs is kept.
+Results are written to --output, and when --baseline is given they are compared against a previous
+results file, the script exits with status 1 if any stage is slower or larger than the baseline by more
+than --tolerance. A results file can be saved as a baseline simply by copying it.
+"""
+#%%
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+import numpy as np
+import scipy.sparse as sp
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+from sklearn.neighbors import kneighbors_graph
+
+# compute_reeb settings of the analyze_*.ipynb notebooks, device and nprocs are set from the command line
+PRECOMPUTED = {
+    "swiss_roll": dict(smallest_component=20,overlap=0.1,kwargs={}),
+    "imagenette": dict(smallest_component=25,overlap=0.01,kwargs=dict(split_thd=0.001,nsteps_preprocess=10)),
+    "variants": dict(smallest_component=30,overlap=0.05,kwargs=dict(nsteps_mixing=20,nsteps_preprocess=10)),
+}
+#%%
+def softmax(X):
+    X = X-np.max(X,1,keepdims=True)
+    np.exp(X,out=X)
+    X /= np.sum(X,1,keepdims=True)
+    return X
+
+def synthetic_masks(nn_model,n,rng,train_percent=0.1):
+    nn_model.train_mask = (rng.random(n) < train_percent).astype(np.float64)
+    nn_model.val_mask = np.zeros(n)
+    nn_model.test_mask = 1-nn_model.train_mask
+
+"""
+Stochastic block model with nclasses equal contiguous blocks, every node draws avg_degree/2 edges of
+which a fraction p_out goes to a uniformly random node and the rest stays in its block. The lens is a
+softmax over noisy logits that favor the true block for a fraction accuracy of the nodes and a random
+block otherwise.
+"""
+def sbm_graph(n,nclasses=10,avg_degree=10,p_out=0.05,accuracy=0.8,noise=1.0,seed=0):
+    from GTDA.GTDA_utils import NN_model
+    rng = np.random.default_rng(seed)
+    labels = np.minimum(np.arange(n,dtype=np.int64)*nclasses//n,nclasses-1)
+    starts = np.searchsorted(labels,np.arange(nclasses))
+    sizes = np.diff(np.r_[starts,n])
+    ei = np.repeat(np.arange(n,dtype=np.int64),max(avg_degree//2,1))
+    ej = np.empty(len(ei),dtype=np.int64)
+    is_out = rng.random(len(ei)) < p_out
+    ej[is_out] = rng.integers(0,n,int(np.sum(is_out)))
+    block = labels[ei[~is_out]]
+    ej[~is_out] = starts[block]+(rng.random(len(block))*sizes[block]).astype(np.int64)
+    keep = ei != ej
+    A = sp.csr_matrix((np.ones(int(np.sum(keep))),(ei[keep],ej[keep])),shape=(n,n))
+    A = ((A+A.T) > 0).astype(np.float64)
+    pred_labels = np.where(rng.random(n) < accuracy,labels,rng.integers(0,nclasses,n))
+    logits = noise*rng.standard_normal((n,nclasses))
+    logits[np.arange(n),pred_labels] += 2.0
+    nn_model = NN_model()
+    nn_model.A,nn_model.preds,nn_model.labels = A,softmax(logits),labels
+    synthetic_masks(nn_model,n,rng)
+    return nn_model
+
+"""
+Symmetric kNN graph of points sampled from a mixture of nclasses gaussians in dim dimensions, the lens is
+a softmax over the negative squared distances to the mixture centers.
+"""
+def knn_graph(n,nclasses=10,dim=2,n_neighbors=5,spread=1.0,temperature=1.0,seed=0):
+    from GTDA.GTDA_utils import NN_model
+    rng = np.random.default_rng(seed)
+    centers = 3*rng.standard_normal((nclasses,dim))
+    labels = rng.integers(0,nclasses,n)
+    X = centers[labels]+spread*rng.standard_normal((n,dim))
+    A = kneighbors_graph(X,n_neighbors=n_neighbors,include_self=False)
+    A = ((A+A.T) > 0).astype(np.float64)
+    dists = np.sum(X**2,1,keepdims=True)-2*X@centers.T+np.sum(centers**2,1)
+    nn_model = NN_model()
+    nn_model.A,nn_model.preds,nn_model.labels = A,softmax(-dists/temperature),labels
+    synthetic_masks(nn_model,n,rng)
+    return nn_model
+
+def load_case(case,root):
+    if case["source"] == "precomputed":
+        from GTDA.GTDA_utils import load_precomputed
+        return load_precomputed(case["dataset"],root=root)
+    generator = sbm_graph if case["source"] == "sbm" else knn_graph
+    return generator(case["n"],nclasses=case["nclasses"],seed=case["seed"]),None
+#%%
+def summarize_profile(profile):
+    stages = {}
+    for record in profile["stages"]:
+        summary = stages.setdefault(
+            record["name"],{"wall_time":0.0,"cpu_time":0.0,"rss_delta":0,"process_peak_rss":0,"calls":0})
+        summary["wall_time"] += record["wall_time"]
+        summary["cpu_time"] += record["cpu_time"]
+        summary["rss_delta"] = max(summary["rss_delta"],record["rss_delta"] or 0)
+        summary["process_peak_rss"] = max(summary["process_peak_rss"],record["process_peak_rss"] or 0)
+        summary["calls"] += 1
+    return stages
+
+def run_gtda(nn_model,extra_lens,case,args,profiler):
+    from GTDA.GTDA_utils import compute_reeb
+    from GTDA.GTDA import GTDA
+    labels_to_eval = list(range(nn_model.preds.shape[1]))
+    kwargs = dict(
+        node_size_thd=5,reeb_component_thd=5,nprocs=args.nprocs,device=args.device,extra_lens=extra_lens,
+        nshards=args.nshards,**case["kwargs"])
+    with profiler.stage("compute_reeb"):
+        GTDA_record = compute_reeb(
+            GTDA,nn_model,labels_to_eval,case["smallest_component"],case["overlap"],**kwargs)
+    for record in GTDA_record["profile"]["stages"]:
+        record["depth"] += 1
+        profiler.stages.append(record)
+    for name,value in GTDA_record["profile"]["counters"].items():
+        profiler.count(name,value)
+    return {"reeb_nodes":int(GTDA_record["g_reeb"].shape[0]),"reeb_edges":int(GTDA_record["g_reeb"].nnz//2)}
+
+def run_tda(nn_model,extra_lens,case,args,profiler):
+    from GTDA.TDA import TDA
+    labels_to_eval = list(range(min(args.tda_cols,nn_model.preds.shape[1])))
+    tda = TDA(nn_model,labels_to_eval)
+    with profiler.stage("build_mixing_matrix"):
+        M,Ar = tda.build_mixing_matrix(standardize=True)
+    with profiler.stage("find_reeb_nodes"):
+        tda.find_reeb_nodes(M,Ar,nbins=args.tda_nbins,overlap=0.1)
+    with profiler.stage("build_reeb_graph"):
+        g_reeb = tda.build_reeb_graph(M)
+    return {"reeb_nodes":int(g_reeb.shape[0]),"reeb_edges":int(g_reeb.nnz//2)}
+
+# runs in a fresh process, the peak RSS of the case is measured against the RSS after loading the graph
+def run_case(case,args):
+    from GTDA.GTDA_utils import StageProfiler, peak_rss
+    t1 = time.perf_counter()
+    nn_model,extra_lens = load_case(case,args.root)
+    load_time = time.perf_counter()-t1
+    load_rss = peak_rss() or 0
+    profiler = StageProfiler()
+    out = io.StringIO()
+    with contextlib.redirect_stdout(sys.stdout if args.verbose else out),\
+            contextlib.redirect_stderr(sys.stderr if args.verbose else out):
+        t1 = time.perf_counter()
+        run = run_gtda if case["engine"] == "gtda" else run_tda
+        info = run(nn_model,extra_lens,case,args,profiler)
+        total_time = time.perf_counter()-t1
+    return {
+        "n":int(nn_model.A.shape[0]),"nnz":int(nn_model.A.nnz),"load_time":load_time,"load_rss":load_rss,
+        "total_time":total_time,"peak_rss":peak_rss() or 0,"stages":summarize_profile(profiler.to_dict()),
+        "counters":dict(profiler.counters),**info}
+
+def make_cases(args):
+    cases = []
+    for engine in args.engines:
+        for name in args.datasets:
+            cases.append(dict(
+                name=f"{engine}/{name}",engine=engine,source="precomputed",dataset=name,
+                smallest_component=PRECOMPUTED[name]["smallest_component"],
+                overlap=PRECOMPUTED[name]["overlap"],kwargs=PRECOMPUTED[name]["kwargs"]))
+        for source in args.synthetic:
+            for n in args.sizes:
+                cases.append(dict(
+                    name=f"{engine}/{source}_{n}",engine=engine,source=source,n=n,nclasses=args.nclasses,
+                    seed=args.seed,smallest_component=args.smallest_component,overlap=args.overlap,kwargs={}))
+    return cases
+#%%
+def environment():
+    try:
+        commit = subprocess.run(
+            ["git","rev-parse","HEAD"],capture_output=True,text=True,cwd=os.path.dirname(os.path.abspath(__file__)))
+        commit = commit.stdout.strip() or None
+    except OSError:
+        commit = None
+    import scipy
+    return {
+        "commit":commit,"python":platform.python_version(),"numpy":np.__version__,"scipy":scipy.__version__,
+        "platform":platform.platform(),"cpu_count":os.cpu_count(),"time":time.strftime("%Y-%m-%d %H:%M:%S")}
+
+# keep the fastest run of every case, peak memory is taken from the same run
+def best_of(runs):
+    return min(runs,key=lambda result: result["total_time"])
+
+"""
+Compare results with a baseline case by case on total time, peak RSS and the wall time of every stage.
+A metric regresses if it grows by more than a fraction tolerance of the baseline and by more than
+min_time seconds or min_bytes bytes, which keeps noise on tiny stages from failing the comparison.
+"""
+def compare_results(results,baseline,tolerance=0.1,min_time=0.05,min_bytes=1<<24):
+    rows,regressions = [],[]
+    for name,result in results["cases"].items():
+        if name not in baseline["cases"]:
+            continue
+        base = baseline["cases"][name]
+        metrics = [("total_time",result["total_time"],base["total_time"],min_time),
+            ("peak_rss",result["peak_rss"]-result["load_rss"],base["peak_rss"]-base["load_rss"],min_bytes)]
+        for stage,summary in result["stages"].items():
+            if stage in base["stages"]:
+                metrics.append((stage,summary["wall_time"],base["stages"][stage]["wall_time"],min_time))
+        for metric,new,old,min_diff in metrics:
+            ratio = new/old if old > 0 else float("inf") if new > 0 else 1.0
+            regressed = new-old > max(tolerance*old,min_diff)
+            rows.append((name,metric,old,new,ratio,regressed))
+            if regressed:
+                regressions.append((name,metric))
+    return rows,regressions
+
+def print_comparison(rows):
+    print(f"{'case':<28}{'metric':<24}{'baseline':>14}{'current':>14}{'ratio':>8}")
+    for name,metric,old,new,ratio,regressed in rows:
+        if metric == "peak_rss":
+            old,new = f"{old/2**20:.1f}MB",f"{new/2**20:.1f}MB"
+        else:
+            old,new = f"{old:.3f}s",f"{new:.3f}s"
+        print(f"{name:<28}{metric:<24}{old:>14}{new:>14}{ratio:>8.2f}{'  REGRESSION' if regressed else ''}")
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark compute_reeb and TDA.")
+    parser.add_argument("--engines",nargs="+",default=["gtda","tda"],choices=["gtda","tda"])
+    parser.add_argument("--datasets",nargs="*",default=list(PRECOMPUTED),choices=list(PRECOMPUTED))
+    parser.add_argument("--synthetic",nargs="*",default=["sbm","knn"],choices=["sbm","knn"])
+    parser.add_argument("--sizes",nargs="*",type=int,default=[10000,100000])
+    parser.add_argument("--nclasses",type=int,default=10)
+    parser.add_argument("--seed",type=int,default=0)
+    parser.add_argument("--smallest-component",type=int,default=100)
+    parser.add_argument("--overlap",type=float,default=0.025)
+    parser.add_argument("--tda-cols",type=int,default=3)
+    parser.add_argument("--tda-nbins",type=int,default=5)
+    parser.add_argument("--nprocs",type=int,default=1)
+    parser.add_argument("--nshards",type=int,default=None)
+    parser.add_argument("--device",default="cpu")
+    parser.add_argument("--repeat",type=int,default=1)
+    parser.add_argument("--root",default="dataset/precomputed")
+    parser.add_argument("--output",default="benchmark_results.json")
+    parser.add_argument("--baseline",default=None)
+    parser.add_argument("--tolerance",type=float,default=0.1)
+    parser.add_argument("--verbose",action="store_true")
+    args = parser.parse_args()
+    results = {"environment":environment(),"args":vars(args),"cases":{}}
+    for case in make_cases(args):
+        runs = []
+        for _ in range(args.repeat):
+            with ProcessPoolExecutor(max_workers=1,mp_context=get_context("spawn")) as executor:
+                runs.append(executor.submit(run_case,case,args).result())
+        results["cases"][case["name"]] = best_of(runs)
+        result = results["cases"][case["name"]]
+        print(f"{case['name']}: n={result['n']} time={result['total_time']:.3f}s "
+            f"peak_rss={result['peak_rss']/2**20:.1f}MB reeb_nodes={result['reeb_nodes']}",flush=True)
+        with open(args.output,"w") as f:
+            json.dump(results,f,indent=1)
+    if args.baseline is not None:
+        with open(args.baseline,"r") as f:
+            baseline = json.load(f)
+        rows,regressions = compare_results(results,baseline,tolerance=args.tolerance)
+        print_comparison(rows)
+        if len(regressions) > 0:
+            print(f"{len(regressions)} regressions against {args.baseline}")
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,186 @@
+"""
+This file checks that every engine mode of compute_reeb reproduces the stored golden outputs on the graphs under
+'dataset/precomputed', for both split criteria. A GTDA_record is reduced to a fingerprint that does not depend on how reeb nodes are
+numbered: every component of final_components_filtered is identified by a hash of its sorted members, and the
+fingerprint holds the multiset of these hashes, the hashes of filtered_nodes, the edges of g_reeb as pairs of
+hashes and sample_colors_mixing, which is compared within a tolerance. The golden files in 'dataset/golden'
+hold one fingerprint per dataset and split criterion ('<name>.npz' for "diff", '<name>-std.npz' for "std"),
+written by the serial mode of a reference engine with
+    python golden_reeb.py --update
+or, for another checkout such as the commit before an optimization,
+    git worktree add ../gtda-reference <commit>
+    python golden_reeb.py --update --engine-root ../gtda-reference
+and
+    python golden_reeb.py --modes serial parallel loky sharded --criteria diff std
+checks the given modes of this tree against them, the script exits with status 1 if any mode differs.
+The stored files come from the serial mode once merge ties were broken by the smallest key and sample, all
+four modes reproduce them exactly on the three datasets. The engine from before the optimized paths broke
+these ties in the iteration order of python sets and differs from them in a few reeb nodes next to tied
+merges (imagenette and variants). The float32 mode
+is approximate and is not checked by default: it only reproduces the reeb net while the lens ranges being
+split stay well above float32 resolution, which split_thd=0 does not guarantee, and extra edges picked
+among neighbors whose distances only differ in float64 move the mixing rate of a few samples. Running it
+with --modes float32 reports these differences against the float64 golden files.
+"""
+#%%
+import argparse
+import contextlib
+import hashlib
+import io
+import os
+import sys
+import numpy as np
+import scipy.sparse as sp
+from benchmark_reeb import PRECOMPUTED
+
+# compute_reeb options of every engine mode, on top of the dataset settings of benchmark_reeb.py
+MODES = {
+    "serial": dict(nprocs=1),
+    "parallel": dict(nprocs=2,split_backend="threading"),
+    "loky": dict(nprocs=2,split_backend="loky"),
+    "sharded": dict(nprocs=1,nshards=4),
+    "float32": dict(nprocs=1,dtype=np.float32,index_dtype=np.int32),
+}
+# attributes of the GTDA class set for a mode, the parallel modes split every level in workers however small
+MODE_ATTRIBUTES = {
+    "parallel": dict(parallel_min_samples=0),
+    "loky": dict(parallel_min_samples=0),
+}
+# compute_reeb options of every split criterion, each one has its own golden files
+CRITERIA = {
+    "diff": dict(split_criteria="diff"),
+    "std": dict(split_criteria="std"),
+}
+#%%
+def component_hash(members):
+    digest = hashlib.blake2b(np.sort(np.asarray(members,dtype=np.int64)).tobytes(),digest_size=8).digest()
+    return np.frombuffer(digest,dtype=np.uint64)[0]
+
+def fingerprint(GTDA_record):
+    gtda = GTDA_record["gtda"]
+    components = gtda.final_components_filtered
+    keys = list(components.keys())
+    hashes = {key: component_hash(components[key]) for key in keys}
+    filtered = np.array([hashes[key] for key in np.asarray(gtda.filtered_nodes).tolist()],dtype=np.uint64)
+    ei,ej = sp.triu(GTDA_record["g_reeb"]).nonzero()
+    reeb_edges = np.sort(np.vstack([filtered[ei],filtered[ej]]),axis=0).T
+    order = np.lexsort((reeb_edges[:,1],reeb_edges[:,0])) if len(reeb_edges) > 0 else np.zeros(0,dtype=np.int64)
+    return {
+        "components":np.sort(np.array(list(hashes.values()),dtype=np.uint64)),
+        "filtered":np.sort(filtered),
+        "reeb_edges":reeb_edges[order].reshape(-1,2),
+        "sample_colors_mixing":np.asarray(gtda.sample_colors_mixing,dtype=np.float64),
+    }
+
+def multiset_difference(a,b):
+    a,b = (a if a.ndim == 2 else a[:,None]),(b if b.ndim == 2 else b[:,None])
+    rows = np.vstack([a,b])
+    _,inverse = np.unique(rows,axis=0,return_inverse=True)
+    counts_a = np.bincount(inverse[:len(a)],minlength=inverse.max()+1 if len(rows) > 0 else 0)
+    counts_b = np.bincount(inverse[len(a):],minlength=len(counts_a))
+    return int(np.sum(np.maximum(counts_a-counts_b,0))),int(np.sum(np.maximum(counts_b-counts_a,0)))
+
+"""
+Compare a fingerprint with a golden one, returns a list of human readable differences which is empty if
+they match. The hash multisets must be equal, sample_colors_mixing must agree within rtol and atol on
+all but a fraction max_mismatch of the samples.
+"""
+def compare_fingerprints(current,golden,rtol=1e-7,atol=1e-10,max_mismatch=0):
+    differences = []
+    for field in ["components","filtered","reeb_edges"]:
+        if current[field].shape != golden[field].shape or np.any(current[field] != golden[field]):
+            missing,extra = multiset_difference(golden[field],current[field])
+            differences.append(
+                f"{field}: {missing} of {len(golden[field])} golden entries missing, {extra} unexpected entries")
+    colors,golden_colors = current["sample_colors_mixing"],golden["sample_colors_mixing"]
+    if colors.shape != golden_colors.shape:
+        differences.append(f"sample_colors_mixing: shape {colors.shape} instead of {golden_colors.shape}")
+    else:
+        mismatch = int(np.sum(~np.isclose(colors,golden_colors,rtol=rtol,atol=atol)))
+        if mismatch > max_mismatch*len(colors):
+            differences.append(
+                f"sample_colors_mixing: max abs difference {np.max(np.abs(colors-golden_colors)):.3e} "
+                f"on {mismatch} samples")
+    return differences
+
+"""
+compute_reeb and the GTDA class of the package under engine_root, or of this tree if it is None. GTDA
+modules imported before are dropped first, so that golden files can be written by another checkout,
+e.g. the engine before an optimization.
+"""
+def load_engine(engine_root=None):
+    if engine_root is not None:
+        for module in [module for module in sys.modules if module == "GTDA" or module.startswith("GTDA.")]:
+            del sys.modules[module]
+        sys.path.insert(0,os.path.abspath(engine_root))
+    try:
+        from GTDA.GTDA_utils import compute_reeb
+        from GTDA.GTDA import GTDA
+    finally:
+        if engine_root is not None:
+            sys.path.pop(0)
+    return compute_reeb,GTDA
+
+def run_mode(name,mode,nn_model,extra_lens,engine,criterion="diff",verbose=False):
+    compute_reeb,GTDA = engine
+    settings = PRECOMPUTED[name]
+    attributes = MODE_ATTRIBUTES.get(mode,{})
+    saved = {key: GTDA.__dict__[key] for key in attributes if key in GTDA.__dict__}
+    try:
+        for key,value in attributes.items():
+            setattr(GTDA,key,value)
+        with contextlib.redirect_stdout(sys.stdout if verbose else io.StringIO()):
+            return compute_reeb(
+                GTDA,nn_model,list(range(nn_model.preds.shape[1])),settings["smallest_component"],settings["overlap"],
+                extra_lens=extra_lens,node_size_thd=5,reeb_component_thd=5,device="cpu",
+                **dict(settings["kwargs"],**CRITERIA[criterion],**MODES[mode]))
+    finally:
+        for key in attributes:
+            if key in saved:
+                setattr(GTDA,key,saved[key])
+            else:
+                delattr(GTDA,key)
+
+def golden_path(golden_dir,name,criterion="diff"):
+    return os.path.join(golden_dir,f"{name}.npz" if criterion == "diff" else f"{name}-{criterion}.npz")
+
+def main():
+    parser = argparse.ArgumentParser(description="Check compute_reeb engine modes against golden outputs.")
+    parser.add_argument("--datasets",nargs="+",default=list(PRECOMPUTED),choices=list(PRECOMPUTED))
+    parser.add_argument("--modes",nargs="+",default=["serial","parallel","loky","sharded"],choices=list(MODES))
+    parser.add_argument("--criteria",nargs="+",default=list(CRITERIA),choices=list(CRITERIA))
+    parser.add_argument("--root",default="dataset/precomputed")
+    parser.add_argument("--golden-dir",default="dataset/golden")
+    parser.add_argument("--update",action="store_true",help="write golden files from the first mode")
+    parser.add_argument("--engine-root",default=None,help="directory holding the GTDA package to run")
+    parser.add_argument("--rtol",type=float,default=1e-7)
+    parser.add_argument("--atol",type=float,default=1e-10)
+    parser.add_argument("--verbose",action="store_true")
+    args = parser.parse_args()
+    from GTDA.GTDA_utils import load_precomputed
+    engine = load_engine(args.engine_root)
+    failures = 0
+    for name in args.datasets:
+        nn_model,extra_lens = load_precomputed(name,root=args.root)
+        for criterion in args.criteria:
+            path = golden_path(args.golden_dir,name,criterion)
+            if args.update:
+                os.makedirs(args.golden_dir,exist_ok=True)
+                GTDA_record = run_mode(name,args.modes[0],nn_model,extra_lens,engine,criterion,args.verbose)
+                np.savez_compressed(path,**fingerprint(GTDA_record))
+                print(f"{name}/{criterion}: golden file written from mode {args.modes[0]}",flush=True)
+                continue
+            with np.load(path) as f:
+                golden = {field: f[field] for field in f.files}
+            for mode in args.modes:
+                current = fingerprint(run_mode(name,mode,nn_model,extra_lens,engine,criterion,args.verbose))
+                differences = compare_fingerprints(current,golden,rtol=args.rtol,atol=args.atol)
+                print(f"{name}/{criterion}/{mode}: {'OK' if len(differences) == 0 else 'DIFF'}",flush=True)
+                for difference in differences:
+                    print(f"    {difference}")
+                failures += len(differences) > 0
+    if failures > 0:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()